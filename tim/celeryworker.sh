@@ -2,4 +2,4 @@
 
 # Start queue worker processes
 echo Launching Tim queue worker...
-exec celery -A tim worker -E --loglevel=INFO --concurrency=3
\ No newline at end of file
+exec celery -A tim worker -E --loglevel=INFO --pool=${CELERY_POOL:-prefork} --concurrency=${CELERY_CONCURRENCY:-3} --queues=${CELERY_QUEUES:-celery,io,cpu,large}
\ No newline at end of file
@@ -2,13 +2,16 @@ import base64
 import logging
 import pickle
 
+import httplib2
 from dateutil.parser import parse as parse_time
+from django.conf import settings
 from django.utils.timezone import (datetime, is_aware, make_aware, now,
                                    timedelta, timezone)
 from google.auth.credentials import Credentials
-from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp, Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.discovery_cache.base import Cache
 
 from scheduling.models import Block, Event
 
@@ -50,11 +53,35 @@ def _event_up_to_date(sup: dict, child: dict) -> bool:
     return True
 
 
+class _DiscoveryCache(Cache):
+    # Keeps API discovery documents in memory, so that they are only fetched
+    # once per worker process rather than once per connection
+    def __init__(self):
+        self.documents = {}
+
+    def get(self, url):
+        return self.documents.get(url)
+
+    def set(self, url, content):
+        self.documents[url] = content
+
+
+_discovery_cache = _DiscoveryCache()
+
+
 class GcalIntegrator(Integrator):
     def __init__(self, configuration: dict, authentication: dict):
         self.credentials = pickle.loads(base64.b64decode(authentication["token"]))
-        self.credentials.refresh(Request())
-        self.service = build("calendar", "v3", credentials=self.credentials)
+        # Every request times out, so that a hung connection can't hold up
+        # the thread (or worker) making it
+        http = httplib2.Http(timeout=settings.INTEGRATION_TIMEOUT)
+        self.credentials.refresh(Request(http))
+        self.service = build(
+            "calendar",
+            "v3",
+            http=AuthorizedHttp(self.credentials, http=http),
+            cache=_discovery_cache,
+        )
         self.buffer: timedelta = timedelta(
             minutes=int(configuration.get("buffer", "0"))
         )
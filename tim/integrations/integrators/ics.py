@@ -2,6 +2,7 @@ import logging
 
 import requests
 from dateutil.parser import parse as parse_time
+from django.conf import settings
 from django.utils.timezone import (datetime, is_aware, make_aware, timedelta,
                                    timezone)
 from ics import Calendar, Event, parse
@@ -22,7 +23,9 @@ class IcsIntegrator(Integrator):
         self.buffer: timedelta = timedelta(
             minutes=int(configuration.get("buffer", "0"))
         )
-        self.calendar = Calendar(requests.get(self.url).text)
+        self.calendar = Calendar(
+            requests.get(self.url, timeout=settings.INTEGRATION_TIMEOUT).text
+        )
 
     def get_blocks(self, after: datetime = None, until: datetime = None):
         return [
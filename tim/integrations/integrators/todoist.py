@@ -5,6 +5,7 @@ from hashlib import sha1
 
 import requests
 from dateutil.parser import parse as parse_time
+from django.conf import settings
 from django.utils.timezone import (datetime, is_aware, make_aware, timedelta,
                                    timezone)
 from pytimeparse import parse as parse_duration
@@ -22,10 +23,14 @@ class TodoistIntegrator(Integrator):
         logging.debug("Todoist integration connecting...")
         self.token = authentication["token"]
         self.state = requests.get(
-            API_ROOT + "sync", params={"token": self.token, "resource_types": '["all"]'}
+            API_ROOT + "sync",
+            params={"token": self.token, "resource_types": '["all"]'},
+            timeout=settings.INTEGRATION_TIMEOUT,
         ).json()
         self.completed = requests.get(
-            API_ROOT + "completed/get_all", params={"token": self.token}
+            API_ROOT + "completed/get_all",
+            params={"token": self.token},
+            timeout=settings.INTEGRATION_TIMEOUT,
         ).json()["items"]
         logging.debug(
             f"Todoist integration loaded state with {len(self.state['items'])} pending items and {len(self.completed)} completed items."
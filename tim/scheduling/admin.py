@@ -23,6 +23,7 @@ class EventAdmin(admin.ModelAdmin):
     list_display_links = ["created"]
     search_fields = ["content", "progression", "contexts", "flags"]
     list_filter = ["completed", "scheduled", "source", "deadline"]
+    readonly_fields = ["scheduling_digest"]
 
     def response_change(self, request, obj):
         if "_reschedule" in request.POST:
@@ -38,7 +39,7 @@ admin.site.register(models.Event, EventAdmin)
 
 def update_schedules(modeladmin, request, queryset):
     for schedule in queryset:
-        tasks.update_schedule.delay(schedule.pk)
+        tasks.queue_schedule_update(schedule, force=True)
 
 
 update_schedules.short_description = "Update & process schedules"
@@ -51,10 +52,29 @@ class ScheduleAdmin(admin.ModelAdmin):
     list_display_links = ["pk"]
     search_fields = ["rescheduling_behavior", "default_timezone"]
     list_filter = ["rescheduling_behavior"]
+    # Kept up to date by runs
+    readonly_fields = [
+        "last_run_at",
+        "last_run_fingerprint",
+        "last_run_valid_until",
+        "next_run_at",
+        "idle_runs",
+        "last_run_duration",
+        "last_run_events",
+        "last_run_blocks",
+    ]
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            # Only what was edited, so that a concurrent run's bookkeeping
+            # isn't overwritten
+            obj.save(update_fields=form.changed_data)
+        else:
+            obj.save()
 
     def response_change(self, request, obj):
         if "_update" in request.POST:
-            tasks.update_schedule.delay(obj.pk)
+            tasks.queue_schedule_update(obj, force=True)
             self.message_user(
                 request, "This schedule will be recalculated in the background."
             )
@@ -0,0 +1,141 @@
+from copy import copy
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+
+from . import FLAGS
+
+FLAG_BITS = {flag: 1 << index for index, flag in enumerate(FLAGS)}
+
+
+def popcount(mask: int) -> int:
+    return bin(mask).count("1")
+
+
+@lru_cache(maxsize=4096)
+def flag_mask(flags: str) -> int:
+    # The mask of an event's `flags`. Most events share a handful of flag
+    # combinations, so they are only parsed once per worker process.
+    mask = 0
+    for flag in flags.lower().split():
+        mask |= FLAG_BITS.get(flag, 0)
+    return mask
+
+
+class Vocabulary:
+    # Interns context names into bit positions so that contexts can be stored
+    # and compared as integer masks. A vocabulary can be shared by the runs of
+    # several schedules.
+    def __init__(self):
+        self.bits = {}
+        self.masks = {}
+
+    def mask(self, words: [str]) -> int:
+        key = frozenset(words)
+        if key in self.masks:
+            return self.masks[key]
+        mask = 0
+        for word in words:
+            if word not in self.bits:
+                self.bits[word] = 1 << len(self.bits)
+            mask |= self.bits[word]
+        self.masks[key] = mask
+        return mask
+
+
+class CompiledEvent:
+    # Everything the scheduler needs to know about an event, computed once per
+    # run (see `.scheduler.Compiler`). Flags and contexts are bitmasks over
+    # `FLAG_BITS` and a `Vocabulary`.
+    __slots__ = [
+        "pk",
+        "name",
+        "flags",
+        "contexts",
+        "duration",
+        "inception",
+        "deadline",
+        "scheduled",
+        "requested",
+        "changed",
+        "dependencies",
+        "dependents",
+    ]
+
+    def __init__(
+        self,
+        pk,
+        name: str,
+        flags: int = 0,
+        contexts: int = 0,
+        duration: timedelta = None,
+        inception: datetime = None,
+        deadline: datetime = None,
+        scheduled: datetime = None,
+        requested: (time, time, bool) = None,
+        changed: bool = False,
+    ):
+        self.pk = pk
+        self.name = name
+        self.flags = flags
+        self.contexts = contexts
+        self.duration = duration
+        self.inception = inception
+        self.deadline = deadline
+        self.scheduled = scheduled
+        self.requested = requested
+        self.changed = changed
+        self.dependencies: [CompiledEvent] = []
+        self.dependents: [CompiledEvent] = []
+
+    def __str__(self):
+        return self.name
+
+    def detached(self):
+        # A copy without the links to other events
+        record = copy(self)
+        record.dependencies = []
+        record.dependents = []
+        return record
+
+    def has_flag(self, flag: str) -> bool:
+        return self.flags & FLAG_BITS.get(flag.lower(), 0) != 0
+
+    def shared_contexts(self, other) -> int:
+        return popcount(self.contexts & other.contexts)
+
+
+class ScheduleSettings:
+    # The settings of a schedule that affect how it is built
+    __slots__ = [
+        "timezone",
+        "rescheduling_behavior",
+        "slot_minutes",
+        "refine_slots",
+        "engine",
+        "order",
+        "budget",
+        "workers",
+        "parallel_threshold",
+    ]
+
+    def __init__(
+        self,
+        timezone,
+        rescheduling_behavior: str = "EFFICIENCY",
+        slot_minutes: int = 1,
+        refine_slots: bool = False,
+        engine: str = "greedy",
+        order: str = "priority",
+        budget: float = 0,
+        workers: int = 1,
+        parallel_threshold: int = 0,
+    ):
+        self.timezone = timezone
+        self.rescheduling_behavior = rescheduling_behavior
+        self.slot_minutes = slot_minutes
+        self.refine_slots = refine_slots
+        self.engine = engine
+        self.order = order
+        self.budget = budget
+        self.workers = workers
+        self.parallel_threshold = parallel_threshold
@@ -0,0 +1,471 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from heapq import heapify, heappop, heappush, nlargest
+from multiprocessing import get_all_start_methods, get_context
+from statistics import mean
+
+from celery.exceptions import SoftTimeLimitExceeded
+
+from . import vectorized
+from .compiled import CompiledEvent, ScheduleSettings
+from .utils import Availability, Timeline, intersect_windows
+
+# The scheduling core. Everything here works on plain records (see
+# `.compiled`) and never touches the database, so it can be run, measured and
+# pickled independently of the ORM. `.scheduler` loads and saves the models.
+
+_STEP = timedelta(minutes=1)
+_INSTANT = timedelta(microseconds=1)
+
+# The number of slots that are rescored minute by minute when a schedule
+# refines its slots
+_REFINED_SLOTS = 3
+
+
+def _feasible_windows(
+    settings: ScheduleSettings, start: datetime, end: datetime, event: CompiledEvent
+) -> [(datetime, datetime)]:
+    # The (closed) windows in which the event may start, regardless of what
+    # else is on the schedule. Computed once per event and run.
+    if event.has_flag("nobox"):
+        return []
+    if event.inception is not None:
+        start = max(start, event.inception)
+    if start > end:
+        return []
+    windows = [(start, end)]
+
+    if event.requested is not None:
+        earliest, latest, flex = event.requested
+        if not flex:
+            tz = settings.timezone
+            requested_windows = []
+            day = start.astimezone(tz).date()
+            while day <= end.astimezone(tz).date():
+                requested_windows.append(
+                    (
+                        tz.localize(datetime.combine(day, earliest)),
+                        tz.localize(datetime.combine(day, latest)),
+                    )
+                )
+                day += timedelta(days=1)
+            windows = intersect_windows(windows, requested_windows)
+
+    return windows
+
+
+def _snap(anchor: datetime, time: datetime, step: timedelta) -> datetime:
+    # The first time on the grid of `step`s from `anchor` that isn't before
+    # `time` (or the anchor itself).
+    if time <= anchor:
+        return anchor
+    return anchor - ((anchor - time) // step) * step
+
+
+def _candidate_windows(
+    availability: Availability,
+    feasible: [(datetime, datetime)],
+    timeline: Timeline,
+    event: CompiledEvent,
+    step: timedelta,
+) -> [(datetime, datetime)]:
+    # Narrows the feasible windows down to the free time that the event fits in
+    # and that comes after its dependencies. Candidates stay on the grid of
+    # `step`s from the start of the availability interval they fall in.
+    not_before = None
+    for dependency in event.dependencies:
+        if (placement := timeline.placement(dependency.pk)) is None:
+            return []
+        after = placement + _INSTANT
+        if not_before is None or after > not_before:
+            not_before = after
+
+    duration = max(event.duration or timedelta(), _INSTANT)
+    candidates = []
+    for window_start, window_end in feasible:
+        for block_start, block_end in availability.between(
+            window_start, window_end + _INSTANT
+        ):
+            first = max(window_start, not_before or window_start)
+            first = _snap(block_start, first, step)
+            last = min(window_end, block_end - duration)
+            if first <= last:
+                candidates.append((first, last))
+    return candidates
+
+
+def _suitability_at(
+    settings: ScheduleSettings,
+    start: datetime,
+    timeline: Timeline,
+    event: CompiledEvent,
+):
+    factors = [0]
+
+    # Time suitability
+    if event.requested is not None:
+        earliest, latest, _ = event.requested
+        t = start.astimezone(tz=settings.timezone).time()
+        if t < earliest or t > latest:
+            factors.append(-10)
+        else:
+            factors.append(10)
+
+    # Context suitability
+    if (prior := timeline.before(start)) is not None:
+        factors.append(prior.shared_contexts(event))
+
+    # Prior time suitability
+    if settings.rescheduling_behavior == "CONSISTENCY" and event.scheduled is not None:
+        factors.append(
+            max(0, 12 - 6 * abs((event.scheduled - start).total_seconds() / 3600))
+        )
+
+    return mean(factors)
+
+
+def _scored_times(
+    settings: ScheduleSettings,
+    candidates: [(datetime, datetime)],
+    timeline: Timeline,
+    event: CompiledEvent,
+    step: timedelta,
+    count: int,
+    offset: int = 0,
+) -> [(float, int, datetime)]:
+    # The `count` best `(suitability, -index, candidate)` triples, where
+    # `index` counts the candidates scanned, starting from `offset`.
+    scored = []
+    for candidate, last in candidates:
+        while candidate <= last:
+            suitability = _suitability_at(settings, candidate, timeline, event)
+            scored.append((suitability, -(offset + len(scored)), candidate))
+            candidate += step
+    return nlargest(count, scored)
+
+
+def _greedy_best_times(
+    settings: ScheduleSettings,
+    candidates: [(datetime, datetime)],
+    timeline: Timeline,
+    event: CompiledEvent,
+    step: timedelta,
+    count: int = 1,
+) -> [datetime]:
+    # The `count` most suitable candidates, best first. Ties go to the
+    # candidate that comes first.
+    scored = _scored_times(settings, candidates, timeline, event, step, count)
+    return [candidate for _, _, candidate in scored]
+
+
+# Process pools for the parallel engine, by number of workers. They are
+# reused for every event and run. The pools are created in workers that
+# already run threads (see `.tasks`), which forking could deadlock, so children
+# are started by a fork server where possible, and spawned otherwise. This
+# module doesn't need Django, so children only have to import it.
+_pools = {}
+if "forkserver" in get_all_start_methods():
+    _pool_context = get_context("forkserver")
+    _pool_context.set_forkserver_preload(["scheduling.core"])
+else:
+    _pool_context = get_context("spawn")
+
+# Set once a pool has failed, after which the parallel engine scores serially
+# for the rest of the process rather than paying to start a pool per event
+_parallel_failed = False
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    if workers not in _pools:
+        _pools[workers] = ProcessPoolExecutor(
+            max_workers=workers, mp_context=_pool_context
+        )
+    return _pools[workers]
+
+
+def _split_candidates(
+    candidates: [(datetime, datetime)], step: timedelta, size: int
+) -> [([(datetime, datetime)], int)]:
+    # Splits the candidates into chunks of at most `size` steps, in scan order.
+    # Returns each chunk with the number of steps that come before it.
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    offset = 0
+    for first, last in candidates:
+        while first <= last:
+            steps = min((last - first) // step + 1, size - chunk_size)
+            chunk.append((first, first + (steps - 1) * step))
+            chunk_size += steps
+            first += steps * step
+            if chunk_size == size:
+                chunks.append((chunk, offset))
+                offset += chunk_size
+                chunk = []
+                chunk_size = 0
+    if len(chunk) > 0:
+        chunks.append((chunk, offset))
+    return chunks
+
+
+def _parallel_best_times(
+    settings: ScheduleSettings,
+    candidates: [(datetime, datetime)],
+    timeline: Timeline,
+    event: CompiledEvent,
+    step: timedelta,
+    count: int = 1,
+) -> [datetime]:
+    # `_greedy_best_times`, with the scan split across a process pool when
+    # there are enough candidates for it to pay off. The chunks keep their
+    # place in the scan order, so ties are broken the same way.
+    global _parallel_failed
+    total = sum((last - first) // step + 1 for first, last in candidates)
+    if _parallel_failed or settings.workers <= 1 or total < settings.parallel_threshold:
+        return _greedy_best_times(settings, candidates, timeline, event, step, count)
+
+    # Links to other events aren't needed to score, and are costly to pickle
+    detached = Timeline()
+    for time, prior in zip(timeline.starts, timeline.events):
+        detached.add(prior.detached(), time)
+    chunks = _split_candidates(candidates, step, -(-total // settings.workers))
+    try:
+        pool = _get_pool(settings.workers)
+        futures = [
+            pool.submit(
+                _scored_times,
+                settings,
+                chunk,
+                detached,
+                event.detached(),
+                step,
+                count,
+                offset,
+            )
+            for chunk, offset in chunks
+        ]
+        scored = [triple for future in futures for triple in future.result()]
+    except SoftTimeLimitExceeded:
+        raise
+    except Exception:
+        # E.g. when the worker isn't allowed to start processes
+        logging.error(
+            "Unable to score in parallel, scoring serially from now on!",
+            exc_info=True,
+        )
+        _parallel_failed = True
+        pool = _pools.pop(settings.workers, None)
+        if pool is not None:
+            pool.shutdown(wait=False)
+        return _greedy_best_times(settings, candidates, timeline, event, step, count)
+    return [candidate for _, _, candidate in nlargest(count, scored)]
+
+
+ENGINES = {
+    "greedy": _greedy_best_times,
+    "vectorized": vectorized.find_best_times,
+    "parallel": _parallel_best_times,
+}
+
+
+def _get_engine(name: str):
+    if name not in ENGINES:
+        raise ValueError(f"unknown scheduling engine '{name}'")
+    return ENGINES[name]
+
+
+def _priority_order(events: [CompiledEvent], timeline: Timeline):
+    # Yields `(event, blocked)` pairs. `events` must be sorted by priority.
+    for event in events:
+        yield event, False
+
+
+def _topological_order(events: [CompiledEvent], timeline: Timeline):
+    # Yields `(event, blocked)` pairs, only handing out an event once all of
+    # its dependencies have been placed. Among the events that are ready, the
+    # highest priority one goes first; `events` must be sorted by priority.
+    # Events whose dependencies can't be placed are yielded as blocked so that
+    # they aren't scanned at all.
+    rank = {event.pk: index for index, event in enumerate(events)}
+    remaining = {}
+    ready = []
+    blocked = []
+    for event in events:
+        waiting = [k for k in event.dependencies if timeline.placement(k.pk) is None]
+        remaining[event.pk] = len(waiting)
+        if any(dependency.pk not in rank for dependency in waiting):
+            blocked.append(event)
+        elif remaining[event.pk] == 0:
+            heappush(ready, rank[event.pk])
+
+    done = set()
+    while len(ready) > 0 or len(blocked) > 0:
+        if len(blocked) > 0:
+            event = blocked.pop()
+            if event.pk in done:
+                continue
+            done.add(event.pk)
+            yield event, True
+        else:
+            event = events[heappop(ready)]
+            if event.pk in done:
+                continue
+            done.add(event.pk)
+            yield event, False
+
+        for dependent in event.dependents:
+            if dependent.pk not in rank or dependent.pk in done:
+                continue
+            if event.scheduled is None:
+                blocked.append(dependent)
+                continue
+            remaining[dependent.pk] -= 1
+            if remaining[dependent.pk] == 0:
+                heappush(ready, rank[dependent.pk])
+
+
+ORDERS = {
+    "priority": _priority_order,
+    "topological": _topological_order,
+}
+
+
+def _get_order(name: str):
+    if name not in ORDERS:
+        raise ValueError(f"unknown scheduling order '{name}'")
+    return ORDERS[name]
+
+
+def _find_time(
+    settings: ScheduleSettings,
+    find_best_times,
+    availability: Availability,
+    feasible: [(datetime, datetime)],
+    timeline: Timeline,
+    event: CompiledEvent,
+) -> datetime:
+    slot = timedelta(minutes=settings.slot_minutes)
+    refine = settings.refine_slots and slot > _STEP
+    candidates = _candidate_windows(availability, feasible, timeline, event, slot)
+    best_times = find_best_times(
+        settings,
+        candidates,
+        timeline,
+        event,
+        slot,
+        _REFINED_SLOTS if refine else 1,
+    )
+    if not refine or len(best_times) == 0:
+        return best_times[0] if len(best_times) > 0 else None
+
+    # Rescore minute by minute around the best slots
+    neighborhoods = []
+    for best_time in sorted(best_times):
+        low, high = best_time - slot + _STEP, best_time + slot - _STEP
+        if len(neighborhoods) > 0 and low <= neighborhoods[-1][1]:
+            neighborhoods[-1] = (neighborhoods[-1][0], high)
+        else:
+            neighborhoods.append((low, high))
+    refined = []
+    for first, last in _candidate_windows(
+        availability, feasible, timeline, event, _STEP
+    ):
+        for low, high in neighborhoods:
+            low = _snap(first, low, _STEP)
+            high = min(last, high)
+            if low <= high:
+                refined.append((low, high))
+    return find_best_times(settings, refined, timeline, event, _STEP)[0]
+
+
+def _kept_placements(
+    events: [CompiledEvent], availability: Availability, timeline: Timeline, end
+) -> [CompiledEvent]:
+    # Events keep their placement unless their inputs changed, or it now
+    # collides with busy time, runs past the end of the window, or no longer
+    # comes after the event's dependencies. Kept events are added to the
+    # availability and timeline.
+    unchanged = sorted(
+        [k for k in events if k.scheduled is not None and not k.changed],
+        key=lambda k: k.scheduled,
+    )
+    # Events without a duration don't take up time, so others may have been
+    # placed over them. They only have to avoid busy time.
+    instants = {
+        event.pk
+        for event in unchanged
+        if not event.duration
+        and availability.is_free(event.scheduled, event.scheduled + _INSTANT)
+    }
+    kept = []
+    for event in unchanged:
+        if not event.duration:
+            if event.pk not in instants or event.scheduled + _INSTANT > end:
+                continue
+        elif event.scheduled + event.duration > end or not availability.is_free(
+            event.scheduled, event.scheduled + event.duration
+        ):
+            continue
+        if any(
+            (placement := timeline.placement(dependency.pk)) is None
+            or placement >= event.scheduled
+            for dependency in event.dependencies
+        ):
+            continue
+        if event.duration:
+            availability.reserve(event.scheduled, event.scheduled + event.duration)
+        timeline.add(event)
+        kept.append(event)
+    return kept
+
+
+def solve(
+    settings: ScheduleSettings,
+    events: [CompiledEvent],
+    busy: [(datetime, datetime)],
+    start: datetime,
+    end: datetime,
+) -> [CompiledEvent]:
+    # Places the events between `start` and `end` around the busy intervals.
+    # Returns the placed events, in the order they were placed, followed by
+    # those that couldn't be placed (whose `scheduled` is None). With the
+    # STABILITY behavior, events that keep their placement are left out.
+    availability = Availability(start, end, busy)
+    timeline = Timeline()
+    if settings.rescheduling_behavior == "STABILITY":
+        kept = {k.pk for k in _kept_placements(events, availability, timeline, end)}
+        logging.debug(f"Keeping the placements of {len(kept)} unchanged events.")
+        events = [event for event in events if event.pk not in kept]
+
+    priorities = vectorized.priorities_at(end, events)
+    ranking = [(-priority, index) for index, priority in enumerate(priorities)]
+    heapify(ranking)
+    events = [events[heappop(ranking)[1]] for _ in range(len(events))]
+
+    scheduled: [CompiledEvent] = []
+    unschedulable: [CompiledEvent] = []
+
+    find_best_times = _get_engine(settings.engine)
+    order = _get_order(settings.order)
+    for event, blocked in order(events, timeline):
+        best_time = None
+        if blocked:
+            logging.debug(f"Event {event} is blocked by an unplaceable dependency.")
+        elif feasible := _feasible_windows(settings, start, end, event):
+            best_time = _find_time(
+                settings, find_best_times, availability, feasible, timeline, event
+            )
+        if best_time is not None:
+            logging.debug(f"Scheduled event {event} for {best_time}.")
+            event.scheduled = best_time
+            if event.duration:
+                availability.reserve(best_time, best_time + event.duration)
+            timeline.add(event)
+            scheduled.append(event)
+        else:
+            logging.debug(f"Unable to find a good time for {event}...")
+            event.scheduled = None
+            unschedulable.append(event)
+
+    return scheduled + unschedulable
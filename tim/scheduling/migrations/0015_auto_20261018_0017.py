@@ -0,0 +1,30 @@
+# Generated by Django 3.1.14 on 2026-10-18 04:17
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scheduling", "0014_auto_20200513_2113"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="schedule",
+            name="refine_slots",
+            field=models.BooleanField(
+                default=False, help_text="Rescore the best slots minute by minute."
+            ),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="slot_minutes",
+            field=models.IntegerField(
+                default=1,
+                help_text="Granularity of the start times that are considered, in minutes.",
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+    ]
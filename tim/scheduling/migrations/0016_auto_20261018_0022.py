@@ -0,0 +1,30 @@
+# Generated by Django 3.1.14 on 2026-10-18 04:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scheduling", "0015_auto_20261018_0017"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="event",
+            name="scheduling_digest",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AlterField(
+            model_name="schedule",
+            name="rescheduling_behavior",
+            field=models.TextField(
+                choices=[
+                    ("CONSISTENCY", "Optimize for consistency"),
+                    ("EFFICIENCY", "Optimize for efficiency"),
+                    ("STABILITY", "Only move events that changed"),
+                ],
+                default="EFFICIENCY",
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-18 04:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scheduling", "0016_auto_20261018_0022"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="schedule",
+            name="last_run_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="last_run_fingerprint",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="last_run_valid_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
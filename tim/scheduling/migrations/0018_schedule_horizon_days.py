@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-18 04:25
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scheduling", "0017_auto_20261018_0024"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="schedule",
+            name="horizon_days",
+            field=models.IntegerField(
+                default=1,
+                help_text="Number of days that are scheduled at once.",
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.14 on 2026-10-18 04:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scheduling", "0018_schedule_horizon_days"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="event",
+            index=models.Index(
+                fields=["schedule", "recurrence_id"],
+                name="scheduling__schedul_8bb047_idx",
+            ),
+        ),
+    ]
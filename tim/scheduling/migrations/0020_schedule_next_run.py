@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-18 04:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scheduling", "0019_auto_20261018_0031"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="schedule",
+            name="idle_runs",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="next_run_at",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-18 04:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scheduling", "0020_schedule_next_run"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="schedule",
+            name="last_run_blocks",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="last_run_duration",
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="last_run_events",
+            field=models.IntegerField(default=0),
+        ),
+    ]
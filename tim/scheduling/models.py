@@ -1,21 +1,57 @@
 import logging
 import uuid
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from datetime import time
 from functools import lru_cache
+from hashlib import sha1
 
 from django.conf import settings
+from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import ExpressionWrapper, F, Func, Min, Q, Value
 from django.shortcuts import reverse
 from django.utils.timezone import datetime, now, timedelta
 from pytz import timezone
 
 from accounts.models import User
 
+# The number of rows or lookup values handled per query by bulk operations
+_CHUNK_SIZE = 500
+
 
 def _default_uuid():
     return uuid.uuid4()
 
 
+class _Seconds(Func):
+    # A number of seconds as a duration, for date arithmetic in the database
+    output_field = models.DurationField()
+    template = "make_interval(secs => %(expressions)s)"
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # SQLite stores durations as microseconds
+        return self.as_sql(
+            compiler,
+            connection,
+            template="(%(expressions)s * 1000000)",
+            **extra_context,
+        )
+
+
+@lru_cache(maxsize=None)
+def _timezone(name: str):
+    return timezone(name)
+
+
+@lru_cache(maxsize=None)
+def _working_days(days_of_week: str) -> (bool,):
+    # Whether each ISO weekday (Monday first) is worked on. Shared by every
+    # schedule that is worked on the same days.
+    days = days_of_week.split()
+    return tuple(str(day) in days for day in range(1, 8))
+
+
 class Block:  # Not stored in database
     start: datetime = None
     end: datetime = None
@@ -36,6 +72,18 @@ class Block:  # Not stored in database
     def overlaps(self, start: datetime, end: datetime) -> bool:
         return not (self.start >= end or self.end <= start)
 
+    @staticmethod
+    def merge(blocks: ["Block"]) -> ["Block"]:
+        # Sorted, non-overlapping blocks covering the same time. Blocks that
+        # merely touch are kept apart so that `overlaps` gives the same answers.
+        merged = []
+        for block in sorted(blocks, key=lambda k: (k.start, k.end)):
+            if len(merged) > 0 and block.start < merged[-1].end:
+                merged[-1] = Block(merged[-1].start, max(merged[-1].end, block.end))
+            else:
+                merged.append(Block(block.start, block.end))
+        return merged
+
 
 class Schedule(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -44,6 +92,7 @@ class Schedule(models.Model):
     RESCHEDULING_CHOICES = [
         ("CONSISTENCY", "Optimize for consistency"),
         ("EFFICIENCY", "Optimize for efficiency"),
+        ("STABILITY", "Only move events that changed"),
     ]
     rescheduling_behavior = models.TextField(
         choices=RESCHEDULING_CHOICES, default="EFFICIENCY"
@@ -54,6 +103,48 @@ class Schedule(models.Model):
     days_of_week = models.TextField(default="1 2 3 4 5 6 7")
     reschedule_after = models.IntegerField(default=1800)
     shift_after_early_completion = models.BooleanField(default=True)
+    slot_minutes = models.IntegerField(
+        default=1,
+        validators=[MinValueValidator(1)],
+        help_text="Granularity of the start times that are considered, in minutes.",
+    )
+    refine_slots = models.BooleanField(
+        default=False,
+        help_text="Rescore the best slots minute by minute.",
+    )
+    horizon_days = models.IntegerField(
+        default=1,
+        validators=[MinValueValidator(1)],
+        help_text="Number of days that are scheduled at once.",
+    )
+
+    # Last run
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    last_run_fingerprint = models.TextField(blank=True, default="")
+    last_run_valid_until = models.DateTimeField(null=True, blank=True)
+
+    # Next run (see `plan_next_run`)
+    next_run_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    idle_runs = models.IntegerField(default=0)
+
+    # Cost of the last run that built the schedule (see `get_cost_class`)
+    last_run_duration = models.FloatField(default=0)
+    last_run_events = models.IntegerField(default=0)
+    last_run_blocks = models.IntegerField(default=0)
+
+    # Settings that affect the outcome of a run
+    RUN_SETTINGS = [
+        "rescheduling_behavior",
+        "default_timezone",
+        "start_day_at",
+        "end_day_at",
+        "days_of_week",
+        "reschedule_after",
+        "shift_after_early_completion",
+        "slot_minutes",
+        "refine_slots",
+        "horizon_days",
+    ]
 
     def __str__(self):
         return f"{self.user} (#{self.pk})"
@@ -62,84 +153,298 @@ class Schedule(models.Model):
         return timedelta(seconds=self.reschedule_after)
 
     def get_timezone(self):
-        return timezone(self.default_timezone)
+        return _timezone(self.default_timezone)
 
-    def get_current_scheduling_block(self) -> (datetime, datetime):
+    def get_scheduling_horizon(self, days: int = None) -> [(datetime, datetime)]:
+        # The working hours of each of the next `days` days (`horizon_days` by
+        # default), skipping days that aren't worked on
+        if days is None:
+            days = self.horizon_days
         tz = self.get_timezone()
         rn = tz.normalize(now())
-        start = max(rn, tz.localize(datetime.combine(rn.date(), self.start_day_at)))
-        end = tz.localize(datetime.combine(rn.date(), self.end_day_at))
+        first_day = rn.date()
         if rn.time() >= self.end_day_at:
             # The end time has passed; time to schedule tomorrow
-            start = tz.localize(
-                datetime.combine(rn.date(), self.start_day_at)
-            ) + timedelta(days=1)
-            end = tz.localize(datetime.combine(rn.date(), self.end_day_at)) + timedelta(
-                days=1
+            first_day += timedelta(days=1)
+
+        working_days = _working_days(self.days_of_week)
+        horizon = []
+        for offset in range(days):
+            day = first_day + timedelta(days=offset)
+            if not working_days[day.isoweekday() - 1]:
+                continue
+            start = tz.localize(datetime.combine(day, self.start_day_at))
+            end = tz.localize(datetime.combine(day, self.end_day_at))
+            horizon.append((max(rn, start), end))
+        return horizon
+
+    def get_off_hours(self, horizon: [(datetime, datetime)]) -> [Block]:
+        # The time between the working hours of a horizon
+        return [
+            Block(previous_end, start)
+            for (_, previous_end), (start, _) in zip(horizon, horizon[1:])
+        ]
+
+    def get_run_fingerprint(
+        self, incoming_events: ["Event"], blocks: [Block], end: datetime
+    ) -> str:
+        # Covers everything from outside of the database that a run depends on.
+        # The start of the scheduling block follows the current time, so only
+        # its end is included; `get_run_valid_until` accounts for the rest.
+        data = sha1()
+        for field in self.RUN_SETTINGS:
+            data.update(f"{field}={getattr(self, field)};".encode("utf-8"))
+        data.update(f"engine={settings.SCHEDULING_ENGINE};".encode("utf-8"))
+        data.update(f"order={settings.SCHEDULING_ORDER};".encode("utf-8"))
+        data.update(f"backend={settings.SCHEDULING_BACKEND};".encode("utf-8"))
+        data.update(f"budget={settings.SCHEDULING_BUDGET};".encode("utf-8"))
+        data.update(f"end={end.timestamp()};".encode("utf-8"))
+        for block in sorted(blocks, key=lambda k: (k.start, k.end)):
+            data.update(
+                f"block={block.start.timestamp()},{block.end.timestamp()};".encode(
+                    "utf-8"
+                )
             )
+        for event in sorted(incoming_events, key=lambda k: (k.source, k.source_id)):
+            data.update(f"event={event.source},{event.source_id}".encode("utf-8"))
+            for field in Event.SYNCED_FIELDS:
+                value = getattr(event, field)
+                if isinstance(value, datetime):
+                    value = value.timestamp()
+                data.update(f",{value}".encode("utf-8"))
+            data.update(b";")
+        return data.hexdigest()
+
+    def get_run_valid_until(self) -> datetime:
+        # The next time at which a run could have a different outcome without
+        # any of its inputs changing: when a scheduled event starts or becomes
+        # overdue (see `clear_overdue_events`), or when an event's inception
+        # passes.
+        rn = now()
+        delay = self.get_reschedule_delay()
+        threshold = rn - delay
+        bounds = self.event_set.filter(completed=False).aggregate(
+            next_inception=Min("inception", filter=Q(inception__gt=rn)),
+            next_start=Min("scheduled", filter=Q(scheduled__gt=rn)),
+            # Overdue cut-offs, less the reschedule delay
+            next_end=Min(
+                ExpressionWrapper(
+                    F("scheduled") + _Seconds("duration"),
+                    output_field=models.DateTimeField(),
+                ),
+                filter=Q(
+                    duration__isnull=False,
+                    scheduled__gt=ExpressionWrapper(
+                        Value(threshold, output_field=models.DateTimeField())
+                        - _Seconds("duration"),
+                        output_field=models.DateTimeField(),
+                    ),
+                ),
+            ),
+            next_untimed=Min(
+                "scheduled", filter=Q(duration=None, scheduled__gt=threshold)
+            ),
+        )
+        times = [bounds["next_inception"], bounds["next_start"]]
+        for key in ["next_end", "next_untimed"]:
+            if bounds[key] is not None:
+                times.append(bounds[key] + delay)
+        return min([k for k in times if k is not None], default=None)
+
+    def is_run_current(self, fingerprint: str) -> bool:
+        # Whether a run with the given fingerprint would have the same outcome
+        # as the last one
+        if self.last_run_at is None or self.last_run_fingerprint != fingerprint:
+            return False
+        if self.last_run_valid_until is not None and self.last_run_valid_until <= now():
+            return False
+        # Events may have been changed outside of a run (e.g. in the admin)
+        return not self.event_set.filter(updated__gt=self.last_run_at).exists()
+
+    def record_run(self, fingerprint: str, valid_until: datetime):
+        # `valid_until` is `get_run_valid_until` as of the run's build
+        self.last_run_at = now()
+        self.last_run_fingerprint = fingerprint
+        self.last_run_valid_until = valid_until
+        self.save(
+            update_fields=[
+                "last_run_at",
+                "last_run_fingerprint",
+                "last_run_valid_until",
+            ]
+        )
 
-        if not str(start.isoweekday()) in self.days_of_week.split():
-            return None
+    def plan_next_run(
+        self, active: bool, valid_until: datetime, blocks: [Block] = None
+    ):
+        # Decides when the schedule is updated next. Runs that find nothing
+        # to do (`active` is false) back the interval off, from
+        # SCHEDULING_MIN_INTERVAL up to SCHEDULING_MAX_INTERVAL minutes, and
+        # outside of working hours the longest interval is used. A run is
+        # never put off past the next time its outcome could change by itself:
+        # the start of working hours or of a block, or an event boundary (see
+        # `valid_until`, from `get_run_valid_until`).
+        horizon = self.get_scheduling_horizon(days=7)
+        rn = now()
+        self.idle_runs = 0 if active else self.idle_runs + 1
+        interval = min(
+            settings.SCHEDULING_MIN_INTERVAL * 2 ** self.idle_runs,
+            settings.SCHEDULING_MAX_INTERVAL,
+        )
+        times = [valid_until]
+        for block in blocks or []:
+            times.extend([block.start, block.end])
+        if len(horizon) == 0 or horizon[0][0] > rn:
+            interval = settings.SCHEDULING_MAX_INTERVAL
+            if len(horizon) > 0:
+                times.append(horizon[0][0])
+        times.append(rn + timedelta(minutes=interval))
+        self.next_run_at = min(k for k in times if k is not None and k > rn)
+        self.save(update_fields=["next_run_at", "idle_runs"])
+        logging.debug(f"Next run of schedule {self.pk} is due at {self.next_run_at}.")
+
+    def record_run_cost(self, duration: float, events: int, blocks: int):
+        self.last_run_duration = duration
+        self.last_run_events = events
+        self.last_run_blocks = blocks
+        self.save(
+            update_fields=["last_run_duration", "last_run_events", "last_run_blocks"]
+        )
 
-        return (start, end)
+    def get_cost_class(self) -> str:
+        # Either "large", if the last run took long to build or had many
+        # events and blocks, or "small"
+        if (
+            self.last_run_duration >= settings.SCHEDULING_LARGE_DURATION
+            or self.last_run_events + self.last_run_blocks
+            >= settings.SCHEDULING_LARGE_SIZE
+        ):
+            return "large"
+        return "small"
+
+    def _load_integration_counterparts(self, incoming_events) -> ["Event"]:
+        # The events that incoming events can affect: those with the same
+        # source id, and incomplete ones with the same recurrence id
+        source_ids = list({event.source_id for event in incoming_events})
+        recurrence_ids = list({event.recurrence_id for event in incoming_events} - {""})
+        events = {}
+        for index in range(0, max(len(source_ids), len(recurrence_ids)), _CHUNK_SIZE):
+            for event in self.event_set.filter(
+                Q(source_id__in=source_ids[index : index + _CHUNK_SIZE])
+                | Q(
+                    completed=False,
+                    recurrence_id__in=recurrence_ids[index : index + _CHUNK_SIZE],
+                )
+            ):
+                events[event.pk] = event
+        return list(events.values())
 
     def process_integration_events(self, incoming_events):
-        events = list(self.event_set.all())
-        # TODO: only deal with events from the last month or so to keep this small
+        existing = self._load_integration_counterparts(incoming_events)
+        events = {event.source_id: event for event in existing}
+        recurrences = defaultdict(list)
+        for event in existing:
+            recurrences[event.recurrence_id].append(event)
+
+        created = []
         for event in incoming_events:
-            try:
-                existing_index = [event.source_id for event in events].index(
-                    event.source_id
-                )
-                events[existing_index].update_from(event)
-            except ValueError:
-                events.append(event)
+            if event.source_id in events:
+                counterpart = events[event.source_id]
+                if "recurrence_id" in counterpart.update_from(event):
+                    recurrences[counterpart.recurrence_id].append(counterpart)
+            else:
+                event.schedule = self
+                events[event.source_id] = event
+                recurrences[event.recurrence_id].append(event)
+                created.append(event)
 
             # Mark older events with the same recurrence id as completed
             if event.recurrence_id != "":
-                for old_event in [
-                    old_event
-                    for old_event in events
-                    if old_event.recurrence_id == event.recurrence_id
-                    and old_event.source_id != event.source_id
-                ]:
-                    old_event.completed = True
-        for event in events:
-            event.schedule = self
-            event.save()
+                for old_event in recurrences[event.recurrence_id]:
+                    if (
+                        old_event.recurrence_id == event.recurrence_id
+                        and old_event.source_id != event.source_id
+                        and not old_event.completed
+                    ):
+                        old_event.completed = True
+
+        logging.debug(f"Creating {len(created)} events from integrations...")
+        self.save_events(existing + created)
+
+    def save_events(self, events: ["Event"]):
+        # Creates the new events and writes the fields that changed on the
+        # others, in bulk. `updated` only advances when something changed.
+        created = [event for event in events if event._state.adding]
+        updated = [
+            event
+            for event in events
+            if not event._state.adding and len(event.get_changed_fields()) > 0
+        ]
+        fields = set()
+        for event in updated:
+            fields.update(event.get_changed_fields())
+            event.updated = now()
+        logging.debug(f"Saving {len(created)} new and {len(updated)} changed events...")
+
+        Event.objects.bulk_create(created, batch_size=_CHUNK_SIZE)
+        if len(updated) > 0:
+            Event.objects.bulk_update(
+                updated, list(fields) + ["updated"], batch_size=_CHUNK_SIZE
+            )
+        for event in created + updated:
+            event.track_changes()
 
     def clear_conflicting_events(self, blocks: [Block]):
-        events = self.event_set.filter(completed=False, scheduled__isnull=False)
-        for event in events:
-            start = event.scheduled
-            end = start + (event.get_duration() or timedelta())
-            for block in blocks:
-                if block.overlaps(start, end):
-                    logging.debug(f"Event {event} overlaps with block, rescheduling...")
-                    event.scheduled = None
-                    event.save()
-                    break
+        # Sweeps through the events and the merged blocks, both sorted by start
+        blocks = Block.merge(blocks)
+        events = self.event_set.filter(
+            completed=False, scheduled__isnull=False
+        ).order_by("scheduled")
+        conflicting = []
+        index = 0
+        for pk, start, duration in events.values_list("pk", "scheduled", "duration"):
+            end = start + timedelta(seconds=duration or 0)
+            # Blocks that end before this event starts end before the rest too
+            while index < len(blocks) and blocks[index].end <= start:
+                index += 1
+            if index < len(blocks) and blocks[index].overlaps(start, end):
+                conflicting.append(pk)
+        logging.debug(f"{len(conflicting)} events overlap with blocks, rescheduling...")
+
+        rn = now()
+        for index in range(0, len(conflicting), _CHUNK_SIZE):
+            self.event_set.filter(
+                pk__in=conflicting[index : index + _CHUNK_SIZE]
+            ).update(scheduled=None, updated=rn)
 
     def clear_overdue_events(self):
-        overdue_candidates = self.event_set.filter(
-            scheduled__lte=now(), completed=False
-        )
-        for candidate in overdue_candidates:
-            if candidate.is_overdue():
-                logging.debug(f"Event {candidate} is overdue, bumping off old time...")
-                candidate.scheduled = None
-                candidate.save()
+        # `Event.is_overdue`, as a single UPDATE: the event's expected end plus
+        # the reschedule delay has passed
+        rn = now()
+        threshold = rn - self.get_reschedule_delay()
+        count = self.event_set.filter(
+            Q(duration=None, scheduled__lt=threshold)
+            | Q(
+                duration__isnull=False,
+                scheduled__lt=ExpressionWrapper(
+                    Value(threshold, output_field=models.DateTimeField())
+                    - _Seconds("duration"),
+                    output_field=models.DateTimeField(),
+                ),
+            ),
+            scheduled__lte=rn,
+            completed=False,
+        ).update(scheduled=None, updated=rn)
+        logging.debug(f"Bumped {count} overdue events off their old times.")
 
     def unschedule_postponed_events(self):
-        for event in self.event_set.filter(
-            completed=False, scheduled__isnull=False, inception__isnull=False
-        ):
-            if event.scheduled < event.inception:
-                logging.debug(
-                    f"Event {event} was scheduled before its inception, bumping off old time..."
-                )
-                event.scheduled = None
-                event.save()
+        count = self.event_set.filter(
+            completed=False,
+            scheduled__isnull=False,
+            inception__isnull=False,
+            scheduled__lt=F("inception"),
+        ).update(scheduled=None, updated=now())
+        logging.debug(f"Bumped {count} events scheduled before their inception.")
 
     def clear_future_completed_events(self):
         self.event_set.filter(scheduled__gt=now(), completed=True).update(
@@ -154,6 +459,7 @@ class Event(models.Model):
     updated = models.DateTimeField(auto_now=True)
     schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE)
     scheduled = models.DateTimeField(null=True, blank=True)
+    scheduling_digest = models.TextField(blank=True, default="")
 
     # Core information (provided by source)
     content = models.TextField(blank=True, default="", db_index=True)
@@ -180,13 +486,43 @@ class Event(models.Model):
         indexes = [
             models.Index(fields=["schedule", "-scheduled"]),
             models.Index(fields=["schedule", "-inception"]),
+            models.Index(fields=["schedule", "recurrence_id"]),
         ]
 
     def __str__(self):
         return f"{str(self.uuid)[:6]}: {self.content}"
 
-    @lru_cache
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.track_changes()
+        return instance
+
+    def track_changes(self):
+        # Remembers the current values, which `get_changed_fields` compares to
+        self._tracked = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if field.attname not in self.get_deferred_fields()
+        }
+
+    def get_changed_fields(self) -> [str]:
+        # Fields that changed since the event was loaded or saved in bulk
+        # (`updated` is managed separately)
+        tracked = getattr(self, "_tracked", {})
+        return [
+            name
+            for name, value in tracked.items()
+            if name != "updated" and getattr(self, name) != value
+        ]
+
+    # Set by `Progressions.attach`, after which dependency lookups no longer
+    # query the database.
+    progressions = None
+
     def get_dependencies(self, incomplete_only=True):
+        if self.progressions is not None:
+            return self.progressions.dependencies(self, incomplete_only)
         if len(self.progression.strip()) == 0:
             return []
         query = models.Q(
@@ -196,8 +532,9 @@ class Event(models.Model):
             query = query & models.Q(completed=False)
         return list(self.schedule.event_set.filter(query))
 
-    @lru_cache
     def get_dependents(self, incomplete_only=True):
+        if self.progressions is not None:
+            return self.progressions.dependents(self, incomplete_only)
         if len(self.progression.strip()) == 0:
             return []
         query = models.Q(
@@ -221,6 +558,43 @@ class Event(models.Model):
                 return self.completed_at - self.scheduled
         return duration
 
+    # Fields that are kept in sync with the source of the event
+    SYNCED_FIELDS = [
+        "content",
+        "inception",
+        "deadline",
+        "duration",
+        "completed",
+        "completed_at",
+        "flags",
+        "contexts",
+        "progression",
+        "progression_order",
+        "source_metadata",
+        "recurrence_id",
+        "source_url",
+    ]
+
+    def get_scheduling_digest(self) -> str:
+        # Changes whenever something that affects the event's placement does
+        data = sha1()
+        for field in [
+            "content",
+            "inception",
+            "deadline",
+            "duration",
+            "completed",
+            "flags",
+            "contexts",
+            "progression",
+            "progression_order",
+        ]:
+            value = getattr(self, field)
+            if isinstance(value, datetime):
+                value = value.timestamp()
+            data.update(f"{field}={value};".encode("utf-8"))
+        return data.hexdigest()
+
     def get_flags(self) -> [str]:
         return set(self.flags.lower().split())
 
@@ -298,27 +672,60 @@ class Event(models.Model):
             string += "🛡️"
         return string
 
-    def update_from(self, other):
-        update_fields = [
-            "content",
-            "inception",
-            "deadline",
-            "duration",
-            "completed",
-            "completed_at",
-            "flags",
-            "contexts",
-            "progression",
-            "progression_order",
-            "source_metadata",
-            "recurrence_id",
-            "source_url",
-        ]
-
-        for field in update_fields:
+    def update_from(self, other) -> [str]:
+        # Returns the fields that changed
+        changed = []
+        default = Event()
+        for field in self.SYNCED_FIELDS:
             if getattr(self, field) != getattr(other, field) and getattr(
                 other, field
-            ) != getattr(Event(), field):
+            ) != getattr(default, field):
                 # If the field on the other event is different and isn't the default,
                 # update self.
                 setattr(self, field, getattr(other, field))
+                changed.append(field)
+        return changed
+
+
+class Progressions:  # Not stored in database
+    # The progression dependency graph of a schedule, loaded with a single
+    # query. Members of each progression are kept sorted by their order, so
+    # dependencies and dependents are the members before and after an event.
+    def __init__(self, events: [Event]):
+        self.members = {}
+        for event in events:
+            if len(event.progression.strip()) > 0:
+                self.members.setdefault(event.progression, []).append(event)
+        self.orders = {}
+        for progression, members in self.members.items():
+            members.sort(key=lambda k: k.progression_order)
+            self.orders[progression] = [k.progression_order for k in members]
+
+    @classmethod
+    def load(cls, schedule: Schedule):
+        return cls(schedule.event_set.exclude(progression=""))
+
+    def attach(self, events: [Event]):
+        for event in events:
+            event.progressions = self
+
+    def _members(self, members: [Event], incomplete_only: bool) -> [Event]:
+        return [k for k in members if not (incomplete_only and k.completed)]
+
+    def dependencies(self, event: Event, incomplete_only=True) -> [Event]:
+        if len(event.progression.strip()) == 0:
+            return []
+        members = self.members.get(event.progression, [])
+        index = bisect_left(
+            self.orders.get(event.progression, []), event.progression_order
+        )
+        return self._members(members[:index], incomplete_only)
+
+    def dependents(self, event: Event, incomplete_only=True) -> [Event]:
+        if len(event.progression.strip()) == 0:
+            return []
+        members = self.members.get(event.progression, [])
+        index = bisect_right(
+            self.orders.get(event.progression, []), event.progression_order
+        )
+        return self._members(members[index:], incomplete_only)
@@ -0,0 +1,182 @@
+import logging
+import random
+from datetime import datetime, timedelta
+from time import process_time
+
+from celery.exceptions import SoftTimeLimitExceeded
+
+from . import core, vectorized
+from .compiled import CompiledEvent, ScheduleSettings
+from .utils import Availability, Timeline
+
+# An anytime local search over whole schedules. It starts from the greedy
+# schedule and keeps shifting and swapping events for as long as its CPU
+# budget allows, holding on to the best schedule found so far. Like `.core`,
+# it never touches the database.
+
+# How much having an event placed at all is worth, relative to how suitable
+# its time is (suitability ranges from -10 to 12). Placing an event always
+# beats placing it well.
+_PLACEMENT_WEIGHT = 25.0
+
+# The share of moves that swap two events rather than shift one
+_SWAP_RATE = 0.3
+
+
+class _Search:
+    def __init__(
+        self,
+        settings: ScheduleSettings,
+        events: [CompiledEvent],
+        fixed: [CompiledEvent],
+        busy: [(datetime, datetime)],
+        start: datetime,
+        end: datetime,
+    ):
+        self.settings = settings
+        self.start = start
+        self.end = end
+        self.slot = timedelta(minutes=settings.slot_minutes)
+        self.random = random.Random(0)
+
+        # Events that keep their placement (see `core._kept_placements`) are
+        # never moved
+        self.fixed = fixed
+        self.fixed_times = {event.pk: event.scheduled for event in fixed}
+        self.busy = busy + [
+            (event.scheduled, event.scheduled + event.duration)
+            for event in fixed
+            if event.duration
+        ]
+        self.free = Availability(start, end, self.busy)
+
+        self.records = {event.pk: event for event in events}
+        self.priorities = dict(zip(self.records, vectorized.priorities_at(end, events)))
+        self.feasible = {
+            event.pk: core._feasible_windows(settings, start, end, event)
+            for event in events
+        }
+        self.movable = [pk for pk, windows in self.feasible.items() if windows]
+
+    def _timeline(self, placements: {str: datetime}) -> Timeline:
+        timeline = Timeline()
+        for event in self.fixed:
+            timeline.add(event)
+        for pk, time in sorted(placements.items(), key=lambda k: k[1]):
+            timeline.add(self.records[pk], time)
+        return timeline
+
+    def score(self, placements: {str: datetime}) -> float:
+        timeline = self._timeline(placements)
+        return sum(
+            self.priorities[pk]
+            * (
+                _PLACEMENT_WEIGHT
+                + core._suitability_at(self.settings, time, timeline, self.records[pk])
+            )
+            for pk, time in placements.items()
+        )
+
+    def is_valid(self, placements: {str: datetime}) -> bool:
+        # The same rules the greedy loop places events by. Events without a
+        # duration don't take up time, so they only have to avoid busy time.
+        availability = Availability(self.start, self.end, self.busy)
+        times = {**self.fixed_times, **placements}
+        for pk, time in sorted(placements.items(), key=lambda k: k[1]):
+            event = self.records[pk]
+            if not any(first <= time <= last for first, last in self.feasible[pk]):
+                return False
+            for dependency in event.dependencies:
+                if (placement := times.get(dependency.pk)) is None or placement >= time:
+                    return False
+            if event.duration:
+                finish = time + event.duration
+                if not availability.is_free(time, finish):
+                    return False
+                availability.reserve(time, finish)
+            elif not self.free.is_free(time, time + core._INSTANT):
+                return False
+        return True
+
+    def _shift(self, placements: {str: datetime}) -> {str: datetime}:
+        # Moves an event (placed or not) to a random time that is free
+        pk = self.random.choice(self.movable)
+        others = {k: time for k, time in placements.items() if k != pk}
+        availability = Availability(self.start, self.end, self.busy)
+        for k, time in others.items():
+            if self.records[k].duration:
+                availability.reserve(time, time + self.records[k].duration)
+        candidates = core._candidate_windows(
+            availability,
+            self.feasible[pk],
+            self._timeline(others),
+            self.records[pk],
+            self.slot,
+        )
+        if len(candidates) == 0:
+            return None
+        first, last = self.random.choice(candidates)
+        steps = (last - first) // self.slot
+        others[pk] = first + self.random.randint(0, steps) * self.slot
+        return others
+
+    def _swap(self, placements: {str: datetime}) -> {str: datetime}:
+        first, second = self.random.sample(list(placements), 2)
+        swapped = dict(placements)
+        swapped[first], swapped[second] = placements[second], placements[first]
+        return swapped
+
+    def run(self, placements: {str: datetime}, budget: float) -> {str: datetime}:
+        deadline = process_time() + budget
+        if len(self.movable) == 0 or not self.is_valid(placements):
+            return placements
+        best, best_score = placements, self.score(placements)
+        current, current_score = best, best_score
+        moves = 0
+        try:
+            while process_time() < deadline:
+                moves += 1
+                if len(current) >= 2 and self.random.random() < _SWAP_RATE:
+                    candidate = self._swap(current)
+                else:
+                    candidate = self._shift(current)
+                if candidate is None or not self.is_valid(candidate):
+                    continue
+                score = self.score(candidate)
+                if score >= current_score:
+                    # Sideways moves are accepted to get across plateaus
+                    current, current_score = candidate, score
+                    if score > best_score:
+                        best, best_score = candidate, score
+        except SoftTimeLimitExceeded:
+            logging.debug("Ran out of time, keeping the best schedule so far.")
+        logging.debug(f"Tried {moves} moves. Best score: {best_score}.")
+        return best
+
+
+def solve(
+    settings: ScheduleSettings,
+    events: [CompiledEvent],
+    busy: [(datetime, datetime)],
+    start: datetime,
+    end: datetime,
+) -> [CompiledEvent]:
+    # Same contract as `core.solve`. The greedy schedule is the starting point,
+    # so the result is never worse than it.
+    previous = {event.pk: event.scheduled for event in events}
+    results = core.solve(settings, events, busy, start, end)
+    placements = {event.pk: event.scheduled for event in results if event.scheduled}
+
+    # Suitability compares against the previous placements
+    returned = {event.pk for event in results}
+    fixed = [event for event in events if event.pk not in returned]
+    for event in results:
+        event.scheduled = previous[event.pk]
+
+    search = _Search(settings, results, fixed, busy, start, end)
+    best = search.run(placements, settings.budget)
+    for event in results:
+        event.scheduled = best.get(event.pk)
+    return [event for event in results if event.scheduled is not None] + [
+        event for event in results if event.scheduled is None
+    ]
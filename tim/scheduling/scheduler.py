@@ -1,15 +1,30 @@
-import logging
 from datetime import datetime, time, timedelta
-from statistics import mean
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models import Q
 from django.utils import timezone
 
-from .models import Block, Event, Schedule
-from .utils import find_availability
+from . import core, optimizer
+from .compiled import CompiledEvent, ScheduleSettings, Vocabulary, flag_mask
+from .models import Block, Event, Progressions, Schedule
 
+# Scheduling backends. A backend takes the schedule's settings, the compiled
+# pending events, the busy intervals and the window to schedule, and returns
+# the events it placed, followed by those it couldn't (see `core.solve`).
+BACKENDS = {
+    "greedy": core.solve,
+    "local_search": optimizer.solve,
+}
 
-def _requested_time(event: Event) -> (time, time, bool):
+
+def _get_backend(name: str):
+    if name not in BACKENDS:
+        raise ImproperlyConfigured(f"unknown scheduling backend '{name}'")
+    return BACKENDS[name]
+
+
+def requested_time(event: Event) -> (time, time, bool):
     earliest = []
     latest = []
     if event.has_flag("morning"):
@@ -29,119 +44,78 @@ def _requested_time(event: Event) -> (time, time, bool):
     return (min(earliest), max(latest), event.has_flag("flex"))
 
 
-def _viable_at(
-    schedule: Schedule,
-    start: datetime,
-    end: datetime,
-    also_scheduled: [Event],
-    event: Event,
-):
-    if event.has_flag("nobox"):
-        return False
-    if event.inception is not None and event.inception > start:
-        return False
-    if event.get_duration() is not None and start + event.get_duration() > end:
-        return False
-
-    for dependency in event.get_dependencies():
-        satisfied = False
-        for other_event in also_scheduled:
-            if other_event.pk == dependency.pk and other_event.scheduled < start:
-                satisfied = True
-        if not satisfied:
-            return False
-
-    if requested_time := _requested_time(event):
-        earliest, latest, flex = requested_time
-        if not flex:
-            t = start.astimezone(tz=schedule.get_timezone()).time()
-            if t < earliest or t > latest:
-                return False
-
-    return True
-
-
-def _priority_at(
-    schedule: Schedule, start: datetime, event: Event, consider_dependents=True
-) -> float:
-    # Find base priority
-    priority = 1.0
-    if event.has_flag("p1"):
-        priority = 4.0
-    elif event.has_flag("p2"):
-        priority = 3.0
-    elif event.has_flag("p3"):
-        priority = 2.0
-    elif event.has_flag("p4"):
-        priority = 1.0
-    elif event.has_flag("minor"):
-        priority = 0.0
-
-    # Give old tasks higher weight, up to 1 points
-    if event.inception is not None:
-        priority += min(abs((start - event.inception).days), 14.0) / 14.0
-
-    # Multiply the task's priority by a deadline coefficient,
-    # starting at 1 and steadily increasing as the deadline approaches
-    if event.deadline is not None:
-        priority *= max(1, ((event.deadline - start).days + 14.0) / 7.0)
-
-    # Scale priority according to the number of other events that the event
-    # is blocking
-    if consider_dependents:
-        for dependent in event.get_dependents():
-            if (
-                dependent.inception is None or dependent.inception <= start
-            ):  # is actually blocked
-                priority += (
-                    _priority_at(schedule, start, dependent, consider_dependents=False)
-                    / 4
-                )
-                # This `/ 4` is somewhat arbitrary. I don't want events with dependencies
-                # to completely overpower everything else. TODO: tweak
-
-    logging.debug(f"Priority for event {event} on {start} is {priority}.")
-
-    return priority
-
-
-def _suitability_at(
-    schedule: Schedule, start: datetime, also_scheduled: [Event], event: Event
-):
-    factors = [0]
-
-    # Time suitability
-    if requested_time := _requested_time(event):
-        earliest, latest, _ = requested_time
-        t = start.astimezone(tz=schedule.get_timezone()).time()
-        if t < earliest or t > latest:
-            factors.append(-10)
-        else:
-            factors.append(10)
-
-    # Context suitability
-    scheduled_before = list(
-        filter(
-            lambda k: k.scheduled < start,
-            sorted(also_scheduled, key=lambda k: k.scheduled),
+class Compiler:
+    # Compiles events, and the progressions they belong to, for one run. This
+    # is where the scheduling core's records are made from the models.
+    def __init__(self, progressions: Progressions, vocabulary: Vocabulary = None):
+        self.progressions = progressions
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self.records = {}
+
+    def _record(self, event: Event) -> CompiledEvent:
+        return CompiledEvent(
+            pk=event.pk,
+            name=str(event),
+            flags=flag_mask(event.flags),
+            contexts=self.vocabulary.mask(event.get_contexts()),
+            duration=event.get_duration(),
+            inception=event.inception,
+            deadline=event.deadline,
+            scheduled=event.scheduled,
+            requested=requested_time(event),
+            changed=event.scheduling_digest != event.get_scheduling_digest(),
         )
-    )
-    if len(scheduled_before) > 0:
-        prior = scheduled_before[-1]
-        factors.append(len(prior.get_contexts() & event.get_contexts()))
-
-    # Prior time suitability
-    if schedule.rescheduling_behavior == "CONSISTENCY" and event.scheduled is not None:
-        factors.append(max(0, 12 - 6 * abs((event.scheduled - start).hours)))
 
-    return mean(factors)
+    def compile(self, event: Event) -> CompiledEvent:
+        # Compiles the event and, so that they can be linked, every event it
+        # is connected to through its progression.
+        if event.pk in self.records:
+            return self.records[event.pk]
+        pending = [event]
+        compiled = []
+        while len(pending) > 0:
+            other = pending.pop()
+            if other.pk in self.records:
+                continue
+            record = self._record(other)
+            self.records[other.pk] = record
+            dependencies = self.progressions.dependencies(other)
+            dependents = self.progressions.dependents(other)
+            compiled.append((record, dependencies, dependents))
+            pending.extend(dependencies + dependents)
+        for record, dependencies, dependents in compiled:
+            record.dependencies = [self.records[k.pk] for k in dependencies]
+            record.dependents = [self.records[k.pk] for k in dependents]
+        return self.records[event.pk]
+
+
+def get_schedule_settings(schedule: Schedule) -> ScheduleSettings:
+    return ScheduleSettings(
+        timezone=schedule.get_timezone(),
+        rescheduling_behavior=schedule.rescheduling_behavior,
+        slot_minutes=schedule.slot_minutes,
+        refine_slots=schedule.refine_slots,
+        engine=settings.SCHEDULING_ENGINE,
+        order=settings.SCHEDULING_ORDER,
+        budget=settings.SCHEDULING_BUDGET,
+        workers=settings.SCHEDULING_WORKERS,
+        parallel_threshold=settings.SCHEDULING_PARALLEL_THRESHOLD,
+    )
 
 
 def build_schedule(
-    schedule: Schedule, blocks: [Block], start: datetime, end: datetime
+    schedule: Schedule,
+    blocks: [Block],
+    start: datetime,
+    end: datetime,
+    progressions: Progressions = None,
+    vocabulary: Vocabulary = None,
 ) -> [Event]:
     # Builds a hypothetical schedule. Returns modified Event objects.
     # Save them to commit to the schedule.
+    if progressions is None:
+        progressions = Progressions.load(schedule)
+
     for event in Event.objects.filter(  # Currently ongoing
         Q(schedule=schedule, completed=False, scheduled__lte=start)
     ):
@@ -160,43 +134,25 @@ def build_schedule(
             if event.scheduled + (event.get_duration() or timedelta()) > start:
                 blocks.extend(event.get_blocks())
 
-    events: [Event] = sorted(
+    pending: [Event] = list(
         Event.objects.filter(
             Q(schedule=schedule, completed=False)
             & (Q(inception=None) | Q(inception__lt=end))
             & (Q(scheduled=None) | Q(scheduled__gte=start))
-        ).order_by("created"),
-        key=lambda k: _priority_at(schedule, end, k),
-        reverse=True,
+        ).order_by("created")
     )
-
-    scheduled: [Event] = []
-    unschedulable: [Event] = []
-
-    while len(events) > 0:
-        availability = find_availability(start, end, blocks)
-        event = events.pop(0)
-        best_time = None
-        highest_suitability = None
-        for block_start, block_end in availability:
-            while block_start < block_end:
-                if _viable_at(schedule, block_start, block_end, scheduled, event):
-                    suitability = _suitability_at(
-                        schedule, block_start, scheduled, event
-                    )
-                    if highest_suitability is None or suitability > highest_suitability:
-                        highest_suitability = suitability
-                        best_time = block_start
-                block_start += timedelta(minutes=1)
-        if best_time is not None:
-            logging.debug(f"Scheduled event {event} for {best_time}.")
-            event.scheduled = best_time
-            if event.get_duration() is not None:
-                blocks.extend(event.get_blocks())
-            scheduled.append(event)
-        else:
-            logging.debug(f"Unable to find a good time for {event}...")
-            event.scheduled = None
-            unschedulable.append(event)
-
-    return scheduled + unschedulable
+    compiler = Compiler(progressions, vocabulary)
+    events = [compiler.compile(event) for event in pending]
+    busy = [(block.start, block.end) for block in blocks]
+
+    # Everything from here on happens in memory
+    instances = {event.pk: event for event in pending}
+    solve = _get_backend(settings.SCHEDULING_BACKEND)
+    results = []
+    for event in solve(get_schedule_settings(schedule), events, busy, start, end):
+        instances[event.pk].scheduled = event.scheduled
+        instances[event.pk].scheduling_digest = instances[
+            event.pk
+        ].get_scheduling_digest()
+        results.append(instances[event.pk])
+    return results
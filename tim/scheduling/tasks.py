@@ -1,94 +1,601 @@
 import logging
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from time import monotonic, time
+from uuid import uuid4
 
-from celery import shared_task
+import redis
+from celery import chord, shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+from django.core import serializers
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models import Q
 from django.utils.timezone import now
 
 from integrations.integrators.base import Integrator
 from integrations.models import Integration
 
-from .models import Block, Event, Schedule
+from .compiled import Vocabulary
+from .models import Block, Event, Progressions, Schedule
 from .scheduler import build_schedule
 from .utils import find_availability
 
+# Calls to integrations are network-bound, so they run on threads. The pool is
+# shared by every schedule update in the worker process to bound the number
+# of concurrent requests. A thread can't be stopped, so a call that times out
+# and has already started is still waited for, until its own requests time
+# out (integrators time every request out after INTEGRATION_TIMEOUT seconds):
+# no call may outlive the run that made it, and with it the schedule's lease.
+_integration_pool = ThreadPoolExecutor(max_workers=settings.INTEGRATION_THREADS)
 
-@shared_task
-def update_all_schedules():
-    for schedule in Schedule.objects.all():
-        update_schedule.delay(schedule.pk)
 
+def _call_integration(function, item):
+    # Runs on a pool thread. A connection the call opens to the database
+    # belongs to the thread, so it's closed rather than left with the thread.
+    try:
+        return function(item)
+    finally:
+        connections.close_all()
 
-@shared_task
-def update_schedule(schedule_pk: str):
-    logging.debug(f"Loading schedule {schedule_pk}...")
 
-    schedule: Schedule = Schedule.objects.get(pk=schedule_pk)
+def _for_each_integration(description: str, function, items: list) -> ([], int):
+    # Calls `function` on every item concurrently. Returns the results of the
+    # calls that succeeded within the timeout, in the order of `items`, and
+    # the number of calls that didn't. A failing call doesn't affect the rest.
+    # Only returns once every call is done or cancelled.
+    futures = [
+        _integration_pool.submit(_call_integration, function, item) for item in items
+    ]
+    deadline = monotonic() + settings.INTEGRATION_TIMEOUT
+    results = []
+    failures = 0
+    try:
+        for item, future in zip(items, futures):
+            try:
+                results.append(future.result(timeout=max(0, deadline - monotonic())))
+            except TimeoutError:
+                logging.error(f"Timed out trying to {description} {item}!")
+                future.cancel()
+                failures += 1
+            except SoftTimeLimitExceeded:
+                # Raised in this thread by the run's time limit, not by a call
+                raise
+            except Exception:
+                logging.error(f"Unable to {description} {item}!", exc_info=True)
+                failures += 1
+    finally:
+        for future in futures:
+            future.cancel()
+        wait(futures)
+    return results, failures
+
+
+# Only one run may update a schedule at a time. A run holds the schedule's
+# lease (in Redis in production, in the local memory cache otherwise) until
+# it's done, or until the lease expires if the run dies. Triggers that arrive
+# in the meantime are coalesced in the cache: they're counted, and once the
+# run is done the schedule is updated once more if there were any.
+_LEASE_KEY = "schedule-lease-{}"
+_REQUESTED_KEY = "schedule-requested-{}"
+_HANDLED_KEY = "schedule-handled-{}"
+_FORCED_KEY = "schedule-forced-{}"
+
+
+# Deletes a lease only if it's still the given one, in a single step, so that
+# a run whose lease expired can't release the lease of a run that took over
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class _RedisLeases:
+    def __init__(self, location: str):
+        self.client = redis.Redis.from_url(location)
+        self.release_script = self.client.register_script(_RELEASE_SCRIPT)
+
+    def acquire(self, key: str, lease: str, timeout: int) -> bool:
+        return bool(self.client.set(key, lease, nx=True, ex=timeout))
+
+    def release(self, key: str, lease: str):
+        self.release_script(keys=[key], args=[lease])
+
+
+class _LocalLeases:
+    # Stands in for `_RedisLeases` in development and tests. The local memory
+    # cache only lives in the process, so a lock makes releasing atomic.
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def acquire(self, key: str, lease: str, timeout: int) -> bool:
+        return cache.add(key, lease, timeout=timeout)
+
+    def release(self, key: str, lease: str):
+        with self.lock:
+            if cache.get(key) == lease:
+                cache.delete(key)
+
+
+if settings.SCHEDULING_LEASE_LOCATION is not None:
+    _leases = _RedisLeases(settings.SCHEDULING_LEASE_LOCATION)
+else:
+    _leases = _LocalLeases()
+
+
+def _start_run(schedule_pk: str, force: bool = False) -> (str, bool):
+    # Returns the lease and whether the run should be forced, or None if the
+    # schedule is already being updated
+    if force:
+        cache.set(_FORCED_KEY.format(schedule_pk), True, timeout=None)
+    cache.add(_REQUESTED_KEY.format(schedule_pk), 0, timeout=None)
+    cache.incr(_REQUESTED_KEY.format(schedule_pk))
+
+    lease = uuid4().hex
+    if not _leases.acquire(
+        _LEASE_KEY.format(schedule_pk), lease, settings.SCHEDULING_LEASE_TIMEOUT
+    ):
+        logging.debug(f"Schedule {schedule_pk} is already being updated!")
+        return None
+    # Every trigger counted so far is handled by this run, as it hasn't
+    # loaded anything yet
+    requested = cache.get(_REQUESTED_KEY.format(schedule_pk))
+    cache.set(_HANDLED_KEY.format(schedule_pk), requested, timeout=None)
+    force = cache.get(_FORCED_KEY.format(schedule_pk), False)
+    if force:
+        cache.delete(_FORCED_KEY.format(schedule_pk))
+    return lease, force
+
+
+def _finish_run(schedule_pk: str, lease: str, rerun):
+    # Releases the lease, and calls `rerun` if the schedule was triggered
+    # while it was held
+    _leases.release(_LEASE_KEY.format(schedule_pk), lease)
+    if cache.get(_REQUESTED_KEY.format(schedule_pk)) != cache.get(
+        _HANDLED_KEY.format(schedule_pk)
+    ):
+        logging.debug(f"Schedule {schedule_pk} was triggered again, rerunning...")
+        rerun.apply_async(
+            (schedule_pk,), queue=_get_queue(Schedule.objects.get(pk=schedule_pk))
+        )
+
+
+def queue_schedule_update(schedule: Schedule, force: bool = False):
+    # Queues `update_schedule` on the queue for the schedule's cost class
+    update_schedule.apply_async(
+        (str(schedule.pk),), {"force": force}, queue=_get_queue(schedule)
+    )
+
 
+@contextmanager
+def _time_limit(soft: int, hard: int):
+    # Raises `SoftTimeLimitExceeded` in the block once `soft` seconds have
+    # passed, like a task's soft time limit does, and again every `hard - soft`
+    # seconds after that in case it was handled (e.g. by `.optimizer`), so
+    # that the block ends by its hard limit. Signals are only delivered to the
+    # main thread, so the block isn't limited on other threads (e.g. when the
+    # worker runs the threads pool).
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def expire(signum, frame):
+        raise SoftTimeLimitExceeded()
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, soft, max(hard - soft, 1))
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _get_queue(schedule: Schedule) -> str:
+    # Large schedules have a queue of their own (see `Schedule.get_cost_class`)
+    # so that they can't hold up small ones, which use the default routing
+    return "large" if schedule.get_cost_class() == "large" else None
+
+
+def _fetch(integration: Integration) -> (Integrator, [Event], [Block]):
+    logging.debug(f"Synchonizing events and blocks from {integration}...")
+    integrator = integration.connect()
+    events = integrator.get_pending_events() + integrator.get_completed_events()
+    return integrator, events, integrator.get_blocks()
+
+
+def _get_horizon(schedule: Schedule) -> [(datetime, datetime)]:
     # Figure out the time period to schedule
-    schedule_block = schedule.get_current_scheduling_block()
-    if schedule_block is None:
+    horizon = schedule.get_scheduling_horizon()
+    if len(horizon) == 0:
         logging.debug("No active scheduling block!")
-        return
+        schedule.plan_next_run(active=False, valid_until=schedule.get_run_valid_until())
     else:
-        start, end = schedule_block
-    logging.debug(f"Found schedule. Will build schedule between {start} and {end}...")
+        logging.debug(
+            f"Found schedule. Will build schedule between {horizon[0][0]} and {horizon[-1][1]}..."
+        )
+    return horizon
 
-    logging.debug(f"Connecting integrations...")
-    integrators: [Integrator] = [
-        integration.connect()
-        for integration in Integration.objects.filter(schedule=schedule)
-    ]
-    logging.debug("Connected to all integrations!")
 
-    logging.debug(f"Loading events from integrations...")
-    incoming_events = []
-    for integrator in integrators:
-        logging.debug(f"Synchonizing events from {type(integrator)}...")
-        incoming_events.extend(integrator.get_pending_events())
-        incoming_events.extend(integrator.get_completed_events())
-    logging.debug(
-        f"Loaded {len(incoming_events)} events from integrations. Synchronizing..."
-    )
+def _build(
+    schedule: Schedule,
+    horizon: [(datetime, datetime)],
+    incoming_events: [Event],
+    blocks: [Block],
+    complete: bool,
+    started: float,
+    force: bool = False,
+    vocabulary: Vocabulary = None,
+) -> (str, datetime):
+    # Synchronizes the fetched events and, if every integration was fetched
+    # (`complete`), builds and saves the schedule. Returns the fingerprint and
+    # the `Schedule.get_run_valid_until` of the run if the schedule has to be
+    # published, None otherwise. `started` is when the run began fetching, as
+    # a timestamp.
+    start, end = horizon[0][0], horizon[-1][1]
+    if not complete:
+        # Without every integration's blocks, busy time could be scheduled over
+        schedule.process_integration_events(incoming_events)
+        logging.debug("Synchronized events, not building the schedule!")
+        schedule.plan_next_run(active=True, valid_until=schedule.get_run_valid_until())
+        return None
+    # Nothing gets scheduled outside of working hours
+    blocks = blocks + schedule.get_off_hours(horizon)
+
+    fingerprint = schedule.get_run_fingerprint(incoming_events, blocks, end)
+    if not force and schedule.is_run_current(fingerprint):
+        logging.debug("Nothing has changed since the last run!")
+        # Nothing has changed, so neither has the last run's boundary
+        schedule.plan_next_run(
+            active=False, valid_until=schedule.last_run_valid_until, blocks=blocks
+        )
+        return None
+
+    logging.debug("Synchronizing events...")
     schedule.process_integration_events(incoming_events)
     logging.debug("Synchronized events!")
 
-    logging.debug("Loading blocks from integrations...")
-    blocks = []
-    for integrator in integrators:
-        logging.debug(f"Synchonizing blocks from {type(integrator)}...")
-        blocks.extend(integrator.get_blocks())
-    logging.debug(f"Loaded {len(blocks)} blocks from integrations.")
+    # Maintenance passes, committed together
+    with transaction.atomic():
+        logging.debug("Clearing conflicting events...")
+        schedule.clear_conflicting_events(blocks)
+        logging.debug("Cleared conflicting")
 
-    logging.debug("Clearing conflicting events...")
-    schedule.clear_conflicting_events(blocks)
-    logging.debug("Cleared conflicting")
+        logging.debug("Bumping overdue events...")
+        schedule.clear_overdue_events()
+        logging.debug("Overdue events bumped!")
 
-    logging.debug("Bumping overdue events...")
-    schedule.clear_overdue_events()
-    logging.debug("Overdue events bumped!")
+        logging.debug("Clearing scheduled times of future completed events...")
+        schedule.clear_future_completed_events()
+        logging.debug("Future completed events cleared!")
 
-    logging.debug("Clearing scheduled times of future completed events...")
-    schedule.clear_future_completed_events()
-    logging.debug("Future completed events cleared!")
+        logging.debug("Unscheduling postponed events...")
+        schedule.unschedule_postponed_events()
+        logging.debug("Postponed events unscheduled!")
 
-    logging.debug("Unscheduling postponed events...")
-    schedule.unschedule_postponed_events()
-    logging.debug("Postponed events unscheduled!")
+    logging.debug("Loading progressions...")
+    progressions = Progressions.load(schedule)
+    logging.debug("Progressions loaded!")
 
     # Build schedule
     logging.debug("Building schedule...")
-    scheduling_results: [Event] = build_schedule(schedule, blocks, start, end)
-    for event in scheduling_results:
-        event.save()
+    scheduling_results: [Event] = build_schedule(
+        schedule, blocks, start, end, progressions, vocabulary
+    )
+    schedule.save_events(scheduling_results)
     logging.debug("New schedule built and saved!")
+    schedule.record_run_cost(time() - started, len(incoming_events), len(blocks))
+    valid_until = schedule.get_run_valid_until()
+    schedule.plan_next_run(active=True, valid_until=valid_until, blocks=blocks)
+    return fingerprint, valid_until
+
+
+def _get_published_events(schedule: Schedule, since: datetime) -> [Event]:
+    # All events that have changes since `since`. Callers publish a week of
+    # them to deal with rescheduled old events, moved things, and other...
+    # potential problems.
+    events = list(
+        schedule.event_set.filter(updated__gt=since).select_related("schedule__user")
+    )
+    Progressions.load(schedule).attach(events)
+    return events
+
+
+def _dump_fetched(events: [Event], blocks: [Block]) -> dict:
+    # What an integration returned, in a form that can be passed between
+    # tasks. Events haven't been saved yet, so they're serialized whole.
+    return {
+        "events": serializers.serialize("json", events),
+        "blocks": [(k.start.isoformat(), k.end.isoformat()) for k in blocks],
+    }
+
+
+def _load_fetched(fetched: dict) -> ([Event], [Block]):
+    events = [k.object for k in serializers.deserialize("json", fetched["events"])]
+    blocks = [
+        Block(start=datetime.fromisoformat(start), end=datetime.fromisoformat(end))
+        for start, end in fetched["blocks"]
+    ]
+    return events, blocks
+
+
+@shared_task
+def update_all_schedules():
+    # Only the schedules that are due (see `Schedule.plan_next_run`). Runs are
+    # planned from when they finish, a little after a tick, so a schedule is
+    # due at the tick closest to its next run rather than the one after it.
+    due = now() + timedelta(minutes=settings.SCHEDULING_BEAT_INTERVAL) / 2
+    schedules = Schedule.objects.filter(
+        Q(next_run_at__isnull=True) | Q(next_run_at__lte=due)
+    ).only("pk", "last_run_duration", "last_run_events", "last_run_blocks")
+    if settings.SCHEDULING_PIPELINE:
+        for schedule in schedules:
+            update_schedule_pipeline.delay(str(schedule.pk))
+        return
+    small = []
+    for schedule in schedules:
+        if _get_queue(schedule) is None:
+            small.append(str(schedule.pk))
+        else:
+            # Large schedules are updated one at a time
+            queue_schedule_update(schedule)
+    size = settings.SCHEDULING_BATCH_SIZE
+    for index in range(0, len(small), size):
+        update_schedules.delay(small[index : index + size])
+
+
+# A batch starts schedules for up to SCHEDULING_SOFT_TIME_LIMIT seconds and
+# requeues the rest, and each schedule gets the soft and hard time limits of
+# its own (see `_time_limit`). The batch's hard limit allows for the last
+# schedule to be started to run up to its hard limit, with some time to spare
+# so that the schedule can still release its lease.
+@shared_task(time_limit=2 * settings.SCHEDULING_TIME_LIMIT)
+def update_schedules(schedule_pks: [str], force: bool = False):
+    # Updates several schedules in one go, so that they share the worker's
+    # caches (timezones, flags, API clients) and a context vocabulary.
+    vocabulary = Vocabulary()
+    deadline = monotonic() + settings.SCHEDULING_SOFT_TIME_LIMIT
+    for index, schedule_pk in enumerate(schedule_pks):
+        if monotonic() >= deadline:
+            logging.debug(f"Out of time, requeueing {len(schedule_pks) - index}...")
+            update_schedules.delay(schedule_pks[index:], force)
+            return
+        try:
+            _update_schedule(schedule_pk, force, vocabulary, limited=True)
+        except SoftTimeLimitExceeded:
+            logging.error(f"Timed out updating schedule {schedule_pk}!")
+        except Exception:
+            # One broken schedule shouldn't hold up the rest of the batch
+            logging.error(f"Unable to update schedule {schedule_pk}!", exc_info=True)
+
+
+@shared_task(
+    soft_time_limit=settings.SCHEDULING_SOFT_TIME_LIMIT,
+    time_limit=settings.SCHEDULING_TIME_LIMIT,
+)
+def update_schedule(schedule_pk: str, force: bool = False):
+    _update_schedule(schedule_pk, force)
+
+
+def _update_schedule(
+    schedule_pk: str,
+    force: bool = False,
+    vocabulary: Vocabulary = None,
+    limited: bool = False,
+):
+    # Updates the schedule holding its lease. If `limited`, the update has time
+    # limits of its own (but releasing the lease doesn't).
+    run = _start_run(schedule_pk, force)
+    if run is None:
+        return
+    lease, force = run
+    try:
+        if limited:
+            with _time_limit(
+                settings.SCHEDULING_SOFT_TIME_LIMIT, settings.SCHEDULING_TIME_LIMIT
+            ):
+                _run_update(schedule_pk, force, vocabulary)
+        else:
+            _run_update(schedule_pk, force, vocabulary)
+    finally:
+        _finish_run(schedule_pk, lease, update_schedule)
+
+
+def _run_update(schedule_pk: str, force: bool, vocabulary: Vocabulary):
+    started = time()
+    logging.debug(f"Loading schedule {schedule_pk}...")
+
+    schedule: Schedule = Schedule.objects.get(pk=schedule_pk)
+    horizon = _get_horizon(schedule)
+    if len(horizon) == 0:
+        return
+
+    logging.debug(f"Loading events and blocks from integrations...")
+    fetched, failures = _for_each_integration(
+        "load from",
+        _fetch,
+        list(
+            Integration.objects.filter(schedule=schedule).select_related(
+                "schedule__user"
+            )
+        ),
+    )
+    integrators: [Integrator] = []
+    incoming_events = []
+    blocks = []
+    for integrator, events, integrator_blocks in fetched:
+        integrators.append(integrator)
+        incoming_events.extend(events)
+        blocks.extend(integrator_blocks)
+    logging.debug(
+        f"Loaded {len(incoming_events)} events and {len(blocks)} blocks from integrations."
+    )
+
+    run = _build(
+        schedule,
+        horizon,
+        incoming_events,
+        blocks,
+        failures == 0,
+        started,
+        force,
+        vocabulary,
+    )
+    if run is None:
+        return
 
     # Publish schedule
     logging.debug("Publishing schedule...")
-    events = list(schedule.event_set.filter(updated__gt=now() - timedelta(weeks=1)))
-    for integrator in integrators:
-        # Write all events that have recent changes. There's a week of buffer to
-        # deal with rescheduled old events, moved things, and other... potential
-        # problems.
-        logging.debug(f"Publishing schedule to {type(integrator)}...")
-        integrator.write_events(events)
+    events = _get_published_events(schedule, now() - timedelta(weeks=1))
+    _, failures = _for_each_integration(
+        "publish to", lambda integrator: integrator.write_events(events), integrators
+    )
+    if failures > 0:
+        # The next run has to publish again, even if nothing changes
+        logging.debug("Schedule not published to all integrations!")
+        return
     logging.debug("Schedule published to all integrations!")
+
+    schedule.record_run(*run)
+
+
+# `update_schedule`, split into a pipeline of tasks: every integration is
+# fetched by its own task, the schedule is built once they're all done, and
+# then every integration is published to by its own task. Fetching and
+# publishing wait on the network while building keeps a CPU busy, so they are
+# routed to separate queues (see `CELERY_TASK_ROUTES`). A fetch or publish
+# that hangs would hold the schedule's lease, so they don't rely on their time
+# limits (which the threads pool of the "io" workers ignores): every request
+# an integrator makes times out after INTEGRATION_TIMEOUT seconds, so a task
+# fails, and the pipeline carries on or releases the lease, in bounded time.
+
+
+@shared_task
+def update_schedule_pipeline(schedule_pk: str, force: bool = False):
+    run = _start_run(schedule_pk, force)
+    if run is None:
+        return
+    lease, force = run
+    try:
+        schedule: Schedule = Schedule.objects.get(pk=schedule_pk)
+        if len(_get_horizon(schedule)) == 0:
+            _finish_run(schedule_pk, lease, update_schedule_pipeline)
+            return
+        integration_pks = [
+            str(pk) for pk in schedule.integration_set.values_list("pk", flat=True)
+        ]
+        build = build_fetched_schedule.s(
+            schedule_pk, integration_pks, lease, time(), force
+        )
+        if (queue := _get_queue(schedule)) is not None:
+            build = build.set(queue=queue)
+        # The lease is held until the pipeline is done, or it fails
+        chord(
+            [fetch_integration.s(integration_pk) for integration_pk in integration_pks],
+            build.on_error(finish_schedule_run.si(schedule_pk, lease)),
+        ).delay()
+    except Exception:
+        _finish_run(schedule_pk, lease, update_schedule_pipeline)
+        raise
+
+
+# A chord's header, so its result is kept
+@shared_task(soft_time_limit=settings.INTEGRATION_TIMEOUT, ignore_result=False)
+def fetch_integration(integration_pk: str) -> dict:
+    # Returns None if the integration couldn't be fetched, so that the build
+    # still runs and synchronizes the rest
+    try:
+        integration = Integration.objects.get(pk=integration_pk)
+        _, events, blocks = _fetch(integration)
+        return _dump_fetched(events, blocks)
+    except SoftTimeLimitExceeded:
+        logging.error(f"Timed out trying to load from {integration_pk}!")
+    except Exception:
+        logging.error(f"Unable to load from {integration_pk}!", exc_info=True)
+    return None
+
+
+@shared_task(
+    soft_time_limit=settings.SCHEDULING_SOFT_TIME_LIMIT,
+    time_limit=settings.SCHEDULING_TIME_LIMIT,
+)
+def build_fetched_schedule(
+    fetched: [dict],
+    schedule_pk: str,
+    integration_pks: [str],
+    lease: str,
+    started: float,
+    force: bool = False,
+):
+    logging.debug(f"Loading schedule {schedule_pk}...")
+
+    schedule: Schedule = Schedule.objects.get(pk=schedule_pk)
+    horizon = _get_horizon(schedule)
+    if len(horizon) == 0:
+        _finish_run(schedule_pk, lease, update_schedule_pipeline)
+        return
+
+    incoming_events = []
+    blocks = []
+    for result in fetched:
+        if result is not None:
+            events, integration_blocks = _load_fetched(result)
+            incoming_events.extend(events)
+            blocks.extend(integration_blocks)
+    logging.debug(
+        f"Loaded {len(incoming_events)} events and {len(blocks)} blocks from integrations."
+    )
+
+    complete = all(result is not None for result in fetched)
+    run = _build(schedule, horizon, incoming_events, blocks, complete, started, force)
+    if run is None:
+        _finish_run(schedule_pk, lease, update_schedule_pipeline)
+        return
+
+    # The run is only recorded once every integration has been published to
+    fingerprint, valid_until = run
+    since = (now() - timedelta(weeks=1)).isoformat()
+    chord(
+        [
+            publish_integration.s(integration_pk, since)
+            for integration_pk in integration_pks
+        ],
+        record_schedule_run.si(
+            schedule_pk,
+            fingerprint,
+            valid_until and valid_until.isoformat(),
+            lease,
+        ).on_error(finish_schedule_run.si(schedule_pk, lease)),
+    ).delay()
+
+
+# A chord's header, so its result is kept
+@shared_task(soft_time_limit=settings.INTEGRATION_TIMEOUT, ignore_result=False)
+def publish_integration(integration_pk: str, since: str):
+    integration = Integration.objects.get(pk=integration_pk)
+    logging.debug(f"Publishing schedule to {integration}...")
+    events = _get_published_events(integration.schedule, datetime.fromisoformat(since))
+    integration.connect().write_events(events)
+
+
+@shared_task
+def record_schedule_run(
+    schedule_pk: str, fingerprint: str, valid_until: str, lease: str
+):
+    try:
+        Schedule.objects.get(pk=schedule_pk).record_run(
+            fingerprint, valid_until and datetime.fromisoformat(valid_until)
+        )
+    finally:
+        _finish_run(schedule_pk, lease, update_schedule_pipeline)
+
+
+@shared_task
+def finish_schedule_run(schedule_pk: str, lease: str):
+    _finish_run(schedule_pk, lease, update_schedule_pipeline)
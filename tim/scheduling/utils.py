@@ -1,29 +1,120 @@
-from datetime import date, time
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
 
-from django.utils.timezone import datetime
 
-from .models import Block
+class Availability:
+    # The free time between `start` and `end`, kept as sorted, disjoint
+    # intervals. Busy time is removed with `reserve`, which only touches the
+    # intervals that actually overlap it.
+    def __init__(
+        self, start: datetime, end: datetime, busy: [(datetime, datetime)] = None
+    ):
+        self.starts = [start]
+        self.ends = [end]
+        for busy_start, busy_end in merge_intervals(busy or []):
+            self.reserve(busy_start, busy_end)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _overlapping(self, start: datetime, end: datetime) -> (int, int):
+        return bisect_right(self.ends, start), bisect_left(self.starts, end)
+
+    def reserve(self, start: datetime, end: datetime):
+        first, last = self._overlapping(start, end)
+        if first >= last:
+            return
+        starts = []
+        ends = []
+        if self.starts[first] < start:
+            starts.append(self.starts[first])
+            ends.append(start)
+        if self.ends[last - 1] > end:
+            starts.append(end)
+            ends.append(self.ends[last - 1])
+        self.starts[first:last] = starts
+        self.ends[first:last] = ends
+
+    def is_free(self, start: datetime, end: datetime) -> bool:
+        first, last = self._overlapping(start, end)
+        return (
+            last - first == 1
+            and self.starts[first] <= start
+            and self.ends[first] >= end
+        )
+
+    def between(self, start: datetime, end: datetime) -> [(datetime, datetime)]:
+        # Free intervals overlapping [start, end). They are not clipped, so
+        # callers can still tell where each interval begins.
+        first, last = self._overlapping(start, end)
+        return list(zip(self.starts[first:last], self.ends[first:last]))
+
+
+class Timeline:
+    # The events placed during a run, kept sorted by start time (events placed
+    # at the same time stay in the order they were added).
+    def __init__(self):
+        self.starts = []
+        self.events = []
+        self.placements = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event, time: datetime = None):
+        # `time` defaults to when the event is scheduled
+        if time is None:
+            time = event.scheduled
+        index = bisect_right(self.starts, time)
+        self.starts.insert(index, time)
+        self.events.insert(index, event)
+        self.placements[event.pk] = time
+
+    def placement(self, pk) -> datetime:
+        return self.placements.get(pk)
+
+    def before(self, time: datetime):
+        # The event that starts last before `time`, if any
+        index = bisect_left(self.starts, time)
+        if index == 0:
+            return None
+        return self.events[index - 1]
+
+
+def merge_intervals(intervals: [(datetime, datetime)]) -> [(datetime, datetime)]:
+    # Sorted, disjoint (start, end) pairs covering the same time. Overlapping
+    # and touching intervals are combined.
+    merged = []
+    for start, end in sorted(intervals):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
 
 def find_availability(
-    start: datetime, end: datetime, blocks: [Block]
+    start: datetime, end: datetime, blocks: ["Block"]
+) -> [(datetime, datetime)]:
+    return list(Availability(start, end, [(k.start, k.end) for k in blocks]))
+
+
+def intersect_windows(
+    first: [(datetime, datetime)], second: [(datetime, datetime)]
 ) -> [(datetime, datetime)]:
-    blocks = sorted(blocks, key=lambda k: k.start)
-
-    available = [(start, end)]
-
-    for block in blocks:
-        for start, end in available:
-            if block.overlaps(start, end):
-                available.remove((start, end))
-                if start < block.start and end <= block.end:
-                    available.append((start, block.start))
-                elif start < block.start and end > block.end:
-                    available.append((start, block.start))
-                    available.append((block.end, end))
-                elif start >= block.start and end > block.end:
-                    available.append((block.end, end))
-                else:
-                    pass  # the availability and block are the same
-
-    return available
+    # Both lists must be chronological and made up of closed, disjoint windows.
+    intersection = []
+    i = j = 0
+    while i < len(first) and j < len(second):
+        start = max(first[i][0], second[j][0])
+        end = min(first[i][1], second[j][1])
+        if start <= end:
+            intersection.append((start, end))
+        if first[i][1] < second[j][1]:
+            i += 1
+        else:
+            j += 1
+    return intersection
@@ -0,0 +1,169 @@
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pytz
+
+from .compiled import FLAG_BITS, CompiledEvent, ScheduleSettings
+from .utils import Timeline
+
+# All times are handled as integer microseconds since the epoch so that the
+# arithmetic (and therefore the chosen placement) is exact.
+_EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+_MINUTE = 60 * 10 ** 6
+_DAY = 24 * 60 * _MINUTE
+
+
+# Base priorities, in order of precedence
+_PRIORITY_FLAGS = [("p1", 4.0), ("p2", 3.0), ("p3", 2.0), ("p4", 1.0), ("minor", 0.0)]
+
+
+def _us(value) -> int:
+    if isinstance(value, time):
+        return (
+            (value.hour * 60 + value.minute) * 60 + value.second
+        ) * 10 ** 6 + value.microsecond
+    if isinstance(value, timedelta):
+        return value // timedelta(microseconds=1)
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _candidates(candidates: [(datetime, datetime)], step: int):
+    # Mirrors the greedy loop: every candidate window is walked in order, one
+    # step at a time, starting from the beginning of the window.
+    windows = []
+    steps = []
+    for index, (first, last) in enumerate(candidates):
+        count = (_us(last) - _us(first)) // step + 1
+        windows.append(np.full(count, index, dtype=np.int64))
+        steps.append(np.arange(count, dtype=np.int64))
+    if len(windows) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(windows), np.concatenate(steps)
+
+
+def _local_times(
+    settings: ScheduleSettings, candidates: [(datetime, datetime)], windows, starts
+):
+    # Local time of day of every candidate, in microseconds since midnight.
+    # UTC offsets are constant within almost every window, so they are only
+    # computed per candidate when a window spans a DST transition.
+    tz = settings.timezone
+    offsets = np.empty(len(starts), dtype=np.int64)
+    for index, (first, last) in enumerate(candidates):
+        mask = windows == index
+        first_offset = _us(first.astimezone(tz).utcoffset())
+        last_offset = _us(last.astimezone(tz).utcoffset())
+        if first_offset == last_offset:
+            offsets[mask] = first_offset
+        else:
+            offsets[mask] = [
+                _us(
+                    (_EPOCH + timedelta(microseconds=int(k))).astimezone(tz).utcoffset()
+                )
+                for k in starts[mask]
+            ]
+    return (starts + offsets) % _DAY
+
+
+def find_best_times(
+    settings: ScheduleSettings,
+    candidates: [(datetime, datetime)],
+    timeline: Timeline,
+    event: CompiledEvent,
+    step: timedelta,
+    count: int = 1,
+) -> [datetime]:
+    # Evaluates `_suitability_at` for every candidate at once. Returns the same
+    # times as the greedy loop: the `count` most suitable candidates, with ties
+    # going to the candidate that comes first.
+    windows, steps = _candidates(candidates, _us(step))
+    if len(windows) == 0:
+        return []
+    starts = (
+        np.array([_us(first) for first, _ in candidates], dtype=np.int64)[windows]
+        + steps * _us(step)
+    )
+
+    # Suitability, as the mean of the factors that apply at each minute
+    totals = np.zeros(len(starts), dtype=np.float64)
+    counts = np.ones(len(starts), dtype=np.int64)
+
+    if event.requested is not None:
+        earliest, latest, _ = event.requested
+        local_times = _local_times(settings, candidates, windows, starts)
+        in_window = (local_times >= _us(earliest)) & (local_times <= _us(latest))
+        totals += np.where(in_window, 10, -10)
+        counts += 1
+
+    if len(timeline) > 0:
+        prior_times = np.array([_us(k) for k in timeline.starts], dtype=np.int64)
+        overlaps = np.array(
+            [prior.shared_contexts(event) for prior in timeline.events],
+            dtype=np.float64,
+        )
+        prior = np.searchsorted(prior_times, starts, side="left") - 1
+        has_prior = prior >= 0
+        totals += np.where(has_prior, overlaps[np.maximum(prior, 0)], 0)
+        counts += has_prior
+
+    if settings.rescheduling_behavior == "CONSISTENCY" and event.scheduled is not None:
+        hours = np.abs(_us(event.scheduled) - starts) / (60 * _MINUTE)
+        totals += np.maximum(0, 12 - 6 * hours)
+        counts += 1
+
+    best = np.argsort(-(totals / counts), kind="stable")[:count]
+    return [candidates[windows[k]][0] + int(steps[k]) * step for k in best]
+
+
+def _own_priorities(start: datetime, events: [CompiledEvent]):
+    # The priority of each event on its own: a base priority from its flags,
+    # raised by up to a point for old events and multiplied by a coefficient
+    # that grows as its deadline approaches
+    flags = np.array([event.flags for event in events], dtype=np.int64)
+    priorities = np.ones(len(events), dtype=np.float64)
+    assigned = np.zeros(len(events), dtype=bool)
+    for flag, priority in _PRIORITY_FLAGS:
+        has_flag = ((flags & FLAG_BITS[flag]) != 0) & ~assigned
+        priorities[has_flag] = priority
+        assigned |= has_flag
+
+    start_us = _us(start)
+    inceptions = np.array(
+        [start_us if k.inception is None else _us(k.inception) for k in events],
+        dtype=np.int64,
+    )
+    priorities += np.minimum(np.abs((start_us - inceptions) // _DAY), 14.0) / 14.0
+
+    deadlines = np.array(
+        [0 if k.deadline is None else _us(k.deadline) for k in events], dtype=np.int64
+    )
+    has_deadline = np.array([k.deadline is not None for k in events], dtype=bool)
+    priorities[has_deadline] *= np.maximum(
+        1, ((deadlines[has_deadline] - start_us) // _DAY + 14.0) / 7.0
+    )
+    return priorities
+
+
+def priorities_at(start: datetime, events: [CompiledEvent]):
+    # The priority of every event at `start`: its own priority, plus a quarter
+    # of that of every dependent it's actually blocking (so that events with
+    # dependents don't overpower everything else). The priority of every
+    # dependent is only computed once, no matter how many events it
+    # contributes to.
+    records = list(events)
+    index = {event.pk: i for i, event in enumerate(records)}
+    for event in events:
+        for dependent in event.dependents:
+            if dependent.pk not in index:
+                index[dependent.pk] = len(records)
+                records.append(dependent)
+    if len(records) == 0:
+        return np.empty(0, dtype=np.float64)
+
+    own = _own_priorities(start, records)
+    priorities = own[: len(events)].copy()
+    for i, event in enumerate(events):
+        for dependent in event.dependents:
+            if dependent.inception is None or dependent.inception <= start:
+                priorities[i] += own[index[dependent.pk]] / 4
+    return priorities
@@ -4,6 +4,7 @@ import os
 
 from celery import Celery
 from celery.schedules import crontab
+from django.conf import settings
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tim.settings")
 
@@ -16,6 +17,6 @@ app.autodiscover_tasks()
 app.conf.beat_schedule = {
     "update-schedules": {
         "task": "scheduling.tasks.update_all_schedules",
-        "schedule": crontab(minute="*/5"),
+        "schedule": crontab(minute=f"*/{settings.SCHEDULING_BEAT_INTERVAL}"),
     },
 }
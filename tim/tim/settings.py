@@ -155,9 +155,90 @@ AUTHENTICATION_BACKENDS = (
 
 CELERY_TASK_ALWAYS_EAGER = os.getenv("CELERY_TASK_ALWAYS_EAGER", "True") == "True"
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND")
+CELERY_TASK_IGNORE_RESULT = True  # Except where a chord needs them
 CELERY_REDIS_SOCKET_TIMEOUT = 15
 
+# Tasks that wait on integrations go to the "io" queue, which is meant for
+# workers with a high concurrency (threads pool), and building schedules goes
+# to the "cpu" queue, which is meant for prefork workers. Everything else goes
+# to the default "celery" queue. The threads pool doesn't enforce time limits,
+# so "io" tasks are bounded by the integrators' INTEGRATION_TIMEOUT on every
+# request instead.
+CELERY_TASK_ROUTES = {
+    "scheduling.tasks.fetch_integration": {"queue": "io"},
+    "scheduling.tasks.publish_integration": {"queue": "io"},
+    "scheduling.tasks.build_fetched_schedule": {"queue": "cpu"},
+}
+
+# Scheduling
+
+# Either "greedy" (the minute-by-minute reference loop), "vectorized" (the
+# NumPy engine) or "parallel" (the reference loop, split across
+# SCHEDULING_WORKERS processes for events with at least
+# SCHEDULING_PARALLEL_THRESHOLD candidate times). All produce the same
+# placements.
+SCHEDULING_ENGINE = os.getenv("SCHEDULING_ENGINE", "greedy")
+SCHEDULING_WORKERS = int(os.getenv("SCHEDULING_WORKERS", str(os.cpu_count() or 1)))
+SCHEDULING_PARALLEL_THRESHOLD = int(
+    os.getenv("SCHEDULING_PARALLEL_THRESHOLD", "5000")
+)
+
+# Either "priority" (events are placed strictly by priority) or "topological"
+# (events are placed once their progression dependencies are, by priority
+# within each level).
+SCHEDULING_ORDER = os.getenv("SCHEDULING_ORDER", "priority")
+
+# Either "greedy" (events are placed one at a time, by priority) or
+# "local_search" (the greedy schedule is improved for up to
+# SCHEDULING_BUDGET seconds of CPU time).
+SCHEDULING_BACKEND = os.getenv("SCHEDULING_BACKEND", "greedy")
+SCHEDULING_BUDGET = float(os.getenv("SCHEDULING_BUDGET", "5"))
+
+# Time limits of a schedule update, in seconds. When the soft limit is hit
+# while the schedule is being optimized, the best schedule so far is kept.
+SCHEDULING_SOFT_TIME_LIMIT = int(os.getenv("SCHEDULING_SOFT_TIME_LIMIT", "240"))
+SCHEDULING_TIME_LIMIT = int(os.getenv("SCHEDULING_TIME_LIMIT", "300"))
+
+# How long, in seconds, a schedule stays locked by a run that died before it
+# could release it. Has to be longer than a run can take, including the time
+# that pipeline tasks spend queued.
+SCHEDULING_LEASE_TIMEOUT = int(os.getenv("SCHEDULING_LEASE_TIMEOUT", "900"))
+
+# The number of threads (shared by all schedule updates in a worker process)
+# that talk to integrations, and how long each call to an integration may
+# take, in seconds
+INTEGRATION_THREADS = int(os.getenv("INTEGRATION_THREADS", "8"))
+INTEGRATION_TIMEOUT = int(os.getenv("INTEGRATION_TIMEOUT", "60"))
+
+# The number of schedules that are updated by each periodic task
+SCHEDULING_BATCH_SIZE = int(os.getenv("SCHEDULING_BATCH_SIZE", "20"))
+
+# How often the beat task looks for schedules that are due, in minutes
+SCHEDULING_BEAT_INTERVAL = int(os.getenv("SCHEDULING_BEAT_INTERVAL", "5"))
+
+# How often each schedule is updated, in minutes. Schedules are updated every
+# SCHEDULING_MIN_INTERVAL minutes while they're active, and less often (down
+# to every SCHEDULING_MAX_INTERVAL minutes) while nothing changes or outside
+# of working hours.
+SCHEDULING_MIN_INTERVAL = int(os.getenv("SCHEDULING_MIN_INTERVAL", "5"))
+SCHEDULING_MAX_INTERVAL = int(os.getenv("SCHEDULING_MAX_INTERVAL", "30"))
+
+# Schedules whose last run took at least SCHEDULING_LARGE_DURATION seconds to
+# build, or had at least SCHEDULING_LARGE_SIZE events and blocks, are updated
+# one at a time on the "large" queue, so that they can't hold up small ones
+SCHEDULING_LARGE_DURATION = float(os.getenv("SCHEDULING_LARGE_DURATION", "20"))
+SCHEDULING_LARGE_SIZE = int(os.getenv("SCHEDULING_LARGE_SIZE", "2000"))
+
+# Whether each schedule is updated by a pipeline of tasks (fetching, building
+# and publishing on separate queues) rather than in batches. The pipeline
+# needs a result backend, which defaults to the broker.
+SCHEDULING_PIPELINE = os.getenv("SCHEDULING_PIPELINE", "False") == "True"
+if SCHEDULING_PIPELINE and CELERY_RESULT_BACKEND is None:
+    CELERY_RESULT_BACKEND = CELERY_BROKER_URL
+
 # Redis cache
+SCHEDULING_LEASE_LOCATION = None
 if not DEBUG and os.getenv("REDIS_CACHE_LOCATION") is not None:
     CACHES = {
         "default": {
@@ -166,3 +247,5 @@ if not DEBUG and os.getenv("REDIS_CACHE_LOCATION") is not None:
             "KEY_PREFIX": "v1_",  # Increment when migrations occur
         }
     }
+    # Schedule leases are held in the same Redis (see `scheduling.tasks`)
+    SCHEDULING_LEASE_LOCATION = os.getenv("REDIS_CACHE_LOCATION")